@@ -0,0 +1,103 @@
+"""
+Cold start cost of the app's hook modules.
+
+Every target is imported in a fresh interpreter, after `frappe` itself, the way a new gunicorn
+or RQ worker loads it on its first event, and reports the wall time and resident memory the
+import added. The per-event targets show what a worker pays for the events it handles;
+`all_modules` is a worker that has loaded the whole package. Run it on two commits and
+compare the outputs to measure a change.
+
+The hooks point at the `events` dispatcher, so by default it is imported with every target.
+To compare against a tree whose hooks point straight at the modules, give another entry module,
+or none, and the targets are imported alone.
+
+    bench benchmark-imports --repeat 5 --output imports.json
+    bench benchmark-imports --entry-module "" --output imports_without_events.json
+"""
+
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+DEFAULT_REPEAT = 5
+
+# Module the hooks resolve first, imported with every target unless another one is given
+ENTRY_MODULE = "custom_app.custom_app.events"
+
+# Modules a worker loads for each kind of event, on top of the entry points
+TARGETS = {
+    "entry_points": [],
+    "inpatient_record_validate": ["custom_app.custom_app.inpatient_handler"],
+    "patient_validate": ["custom_app.custom_app.inpatient"],
+    "service_submit": ["custom_app.custom_app.sales_invoice_services"],
+    "master_update": ["custom_app.custom_app.reference_data", "custom_app.custom_app.service_item_details"],
+    "charge_flush": ["custom_app.custom_app.charge_accumulator"],
+    "all_modules": [
+        "custom_app.custom_app.inpatient_handler",
+        "custom_app.custom_app.inpatient",
+        "custom_app.custom_app.sales_invoice_services",
+        "custom_app.custom_app.charge_accumulator",
+        "custom_app.custom_app.service_queue",
+        "custom_app.custom_app.billing_summary",
+        "custom_app.custom_app.patient_import",
+    ],
+}
+
+# Runs in the fresh interpreter: imports frappe, then the modules given as arguments
+PROBE = """
+import json, resource, sys, time
+
+def rss_kb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize() // 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+import frappe
+
+modules_before, rss_before = len(sys.modules), rss_kb()
+start = time.perf_counter()
+for module in sys.argv[1:]:
+    __import__(module)
+print(json.dumps({
+    "import_ms": (time.perf_counter() - start) * 1000,
+    "rss_kb": rss_kb() - rss_before,
+    "modules": len(sys.modules) - modules_before,
+}))
+"""
+
+
+def run(repeat=DEFAULT_REPEAT, entry_module=ENTRY_MODULE):
+    """
+    Imports every target `repeat` times after `entry_module`, if any, and returns
+    the median figures per target.
+    """
+    entry_modules = [entry_module] if entry_module else []
+    results = []
+    for target, modules in TARGETS.items():
+        if not entry_modules and not modules:
+            # The entry points alone: nothing to import
+            continue
+        samples = [probe([*entry_modules, *modules]) for _ in range(repeat)]
+        results.append({
+            "target": target,
+            "runs": repeat,
+            "import_ms": round(statistics.median(sample["import_ms"] for sample in samples), 2),
+            "rss_kb": statistics.median(sample["rss_kb"] for sample in samples),
+            "modules": samples[-1]["modules"],
+        })
+
+    return {
+        "meta": {"python": platform.python_version(), "entry_module": entry_module, "timestamp": time.time()},
+        "results": results,
+    }
+
+def probe(modules):
+    output = subprocess.run(
+        [sys.executable, "-c", PROBE, *modules], check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
@@ -0,0 +1,754 @@
+"""
+Load test for the clinical-to-billing pipeline.
+
+Seeds a synthetic hospital (items, lab and procedure templates, a practitioner) and, for every
+size, admits a patient with that many prescriptions and drives the real hook chain:
+
+    Patient validate -> Inpatient Record validate (create_services) -> unchanged save ->
+    service submit (the services are really submitted, so their on_submit hooks
+    create_sales_invoice_for_* and submit_or_update_service_request run as in production) -> charge flush
+
+For every size, the creation of the services is also timed batched, as the Inpatient Record
+save does it, and row by row as the app did before (`reference.create_services_per_row`),
+so their round trips and wall time can be compared.
+
+With `lab_tests`, one admission orders that many Lab Tests at once, the way a ward round does,
+and the save that creates them and groups them into Specimens is timed. A check of `DUPLICATE_CHECK_SERVICES` services spread over the three service types is timed
+uncached, grouped by doctype and with a query per service as before
+(`reference.check_duplicate_services_per_service`); the run fails if the grouped check takes
+more than `DUPLICATE_CHECK_MAX_QUERIES` queries.
+
+The rates of the lab templates and drugs are read `PRICE_LOOKUPS` times from the in-process
+price cache, from its site-wide tier and through `frappe.get_doc` as before
+(`reference.get_rate_from_doc`).
+
+With `stay_lines`, a stay of that many charges is billed through the charge accumulator, flushing
+whenever its threshold is reached, and again with an invoice save on every submit as before
+(`reference.add_charge_per_submit`); the elapsed seconds of each are its total billing time.
+With `invoice_history`, that many Sales Invoices of other customers are bulk inserted and the
+patient's draft invoice is looked up through the patient's link (`get_billing_invoice`) and with
+the customer scan it replaced (`reference.get_draft_invoice_by_customer`).
+With `invoice_lines`,
+a draft invoice of that many lines is also submitted as is and again after compaction. With
+`history_sizes`, the hot-path lookups are timed for patients carrying that many archived Lab Tests
+and Service Requests, which should not change their latency. Every stage reports throughput,
+latency percentiles, query counts and peak Python memory.
+
+A service that fails inside the hooks only shows up as a message, so after the stages that create
+or submit services the run checks that every prescription has its service and submitted Service
+Request, and fails when any is missing.
+
+The charge flush commits, so the run cannot be rolled back: every patient it creates and all of
+their services, charges and invoices are deleted when it ends, and before it starts in case an
+earlier run was interrupted. Only run this on a test site (`allow_tests` must be set).
+Masters are reused between runs.
+
+    bench --site test_site benchmark-billing-pipeline --sizes 1,10,100,500,5000 --output results.json
+"""
+
+import json
+import platform
+import time
+import tracemalloc
+from unittest.mock import patch
+
+import frappe
+from frappe.utils import nowdate
+
+from custom_app.benchmarks.reference import (
+    add_charge_per_submit,
+    check_duplicate_services_per_service,
+    create_services_per_row,
+    get_draft_invoice_by_customer,
+    get_rate_from_doc,
+)
+from custom_app.custom_app import charge_accumulator
+from custom_app.custom_app.charge_accumulator import add_charge, flush_pending_charges
+from custom_app.custom_app.inpatient import get_billing_invoice, make_billing_invoice
+from custom_app.custom_app.inpatient_handler import SERVICE_TABLES, check_duplicate_services
+from custom_app.custom_app.instrumentation import get_query_counter, percentile
+from custom_app.custom_app.invoice_compaction import compact_invoice
+from custom_app.custom_app.sales_invoice_services import submit_or_update_service_request
+from custom_app.custom_app.service_item_details import get_rate, price_cache
+
+DEFAULT_SIZES = (1, 10, 100, 500)
+
+# Number of distinct items and templates prescriptions are drawn from
+MASTER_COUNT = 20
+
+# Lab Tests ordered by one admission in the specimen grouping stage
+DEFAULT_LAB_TESTS = 200
+
+# Samples the lab templates are spread over, so the grouping stage creates a few Specimens
+SAMPLE_COUNT = 3
+
+# Hot-path lookups timed per history size
+HISTORY_LOOKUPS = 20
+
+# Services sent in one duplicate check, and the queries it may take: one per service doctype
+DUPLICATE_CHECK_SERVICES = 50
+DUPLICATE_CHECK_MAX_QUERIES = 3
+DUPLICATE_CHECK_RUNS = 20
+
+# Rates read per price lookup stage
+PRICE_LOOKUPS = 1000
+
+# Seeded invoices are spread over this many customers and inserted this many at a time
+INVOICE_HISTORY_CUSTOMERS = 10000
+INVOICE_HISTORY_CHUNK = 10000
+
+# A stage regresses when its p95 latency grows by more than this share over the baseline
+DEFAULT_TOLERANCE = 0.2
+
+PREFIX = "BENCH"
+
+# Documents of the benchmark patients, deleted after every run
+PATIENT_DOCTYPES = (
+    "Pending Charge",
+    "Inpatient Billing Summary",
+    "Specimen",
+    "Lab Test",
+    "Medication Request",
+    "Clinical Procedure",
+    "Service Request",
+    "Patient Medical Record",
+    "Inpatient Record",
+)
+
+
+class Stage:
+    """
+    Collects latency, query and memory figures for one stage of the pipeline.
+    """
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self.latencies = []
+        self.errors = 0
+        self.queries = 0
+        self.rows_written = 0
+        self.elapsed = 0.0
+        self.peak_memory = 0
+
+    def __enter__(self):
+        self.counter = get_query_counter()
+        self.start_queries, self.start_rows = self.counter.queries, self.counter.rows
+        tracemalloc.start()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
+        self.peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.queries = self.counter.queries - self.start_queries
+        self.rows_written = self.counter.rows - self.start_rows
+
+    def measure(self, fn, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            fn(*args, **kwargs)
+        except Exception:
+            self.errors += 1
+            frappe.logger("custom_app.benchmark").exception(f"{self.name} failed")
+        finally:
+            self.latencies.append((time.perf_counter() - start) * 1000)
+            # Messages would otherwise pile up for the whole run
+            frappe.local.message_log = []
+
+    def as_dict(self):
+        latencies = sorted(self.latencies)
+        ops = len(latencies)
+        return {
+            "stage": self.name,
+            "size": self.size,
+            "ops": ops,
+            "errors": self.errors,
+            "elapsed_s": round(self.elapsed, 3),
+            "throughput_per_s": round(ops / self.elapsed, 2) if self.elapsed else None,
+            "p50_ms": percentile(latencies, 50),
+            "p95_ms": percentile(latencies, 95),
+            "p99_ms": percentile(latencies, 99),
+            "queries": self.queries,
+            "queries_per_op": round(self.queries / ops, 2) if ops else None,
+            "rows_written": self.rows_written,
+            "peak_memory_kb": round(self.peak_memory / 1024, 1),
+        }
+
+
+def run(
+    sizes=DEFAULT_SIZES, lab_tests=None, invoice_lines=None, history_sizes=None, stay_lines=None,
+    invoice_history=None, keep_data=False
+):
+    """
+    Runs the pipeline for every size, the specimen grouping stage for `lab_tests`, the invoice
+    compaction stages for `invoice_lines`, the hot-path lookups for every history size, the
+    stay billing stages for every stay length and the invoice lookups against `invoice_history`
+    seeded invoices, and returns the machine-readable results. The data of the run is deleted unless `keep_data`.
+    Must be called on a connected site.
+    """
+    if not frappe.conf.get("allow_tests"):
+        frappe.throw("The billing benchmark only runs on sites with allow_tests enabled.")
+
+    cleanup()
+    results = []
+    try:
+        masters = seed_masters()
+        for size in sizes:
+            results.extend(run_size(masters, size))
+            results.extend(run_service_creation(masters, size))
+        results.extend(run_duplicate_check(masters))
+        results.extend(run_price_lookup(masters))
+        if lab_tests:
+            results.extend(run_lab_tests(masters, lab_tests))
+        if invoice_lines:
+            results.extend(run_compaction(masters, invoice_lines))
+        for history_size in history_sizes or []:
+            results.extend(run_history(masters, history_size))
+        for lines in stay_lines or []:
+            results.extend(run_stay(masters, lines))
+        if invoice_history:
+            results.extend(run_invoice_lookup(invoice_history))
+        frappe.db.commit()
+    finally:
+        if not keep_data:
+            frappe.db.rollback()
+            cleanup()
+
+    return {
+        "meta": {
+            "site": frappe.local.site,
+            "python": platform.python_version(),
+            "frappe": frappe.__version__,
+            "timestamp": time.time(),
+        },
+        "results": results,
+    }
+
+def run_size(masters, size):
+    stages = []
+
+    with Stage("patient_create", size) as stage:
+        patient = frappe.new_doc("Patient")
+        patient.first_name = f"{PREFIX} Patient {size}"
+        patient.sex = "Male"
+        stage.measure(patient.insert, ignore_permissions=True)
+    stages.append(stage)
+
+    inpatient_record = build_inpatient_record(masters, patient.name, size)
+    with Stage("inpatient_validate", size) as stage:
+        stage.measure(inpatient_record.insert, ignore_permissions=True)
+    stages.append(stage)
+    assert_services(stage, inpatient_record)
+
+    # A save that adds no prescriptions, e.g. a discharge date edit
+    with Stage("inpatient_resave", size) as stage:
+        stage.measure(inpatient_record.save, ignore_permissions=True)
+    stages.append(stage)
+
+    services = [
+        (service_doctype, row.custom_linked_document)
+        for fieldname, service_doctype, label, name_field in SERVICE_TABLES
+        for row in inpatient_record.get(fieldname)
+        if row.custom_linked_document
+    ]
+    with Stage("service_submit", size) as stage:
+        for service_doctype, service_name in services:
+            service = frappe.get_doc(service_doctype, service_name)
+            service.flags.ignore_permissions = True
+            stage.measure(service.submit)
+    stages.append(stage)
+    assert_services(stage, inpatient_record, docstatus=1)
+
+    with Stage("charge_flush", size) as stage:
+        stage.measure(flush_pending_charges, patient.name)
+    stages.append(stage)
+
+    return [stage.as_dict() for stage in stages]
+
+def run_service_creation(masters, size):
+    """
+    Times the creation of the services of `size` prescriptions batched and row by row, each on
+    an admission of its own. Both start from a saved record whose admission is only scheduled
+    and include one save of it: the batched path creates the services in the save that admits,
+    the per-row path after it, as the old hook did.
+    """
+    stages = []
+
+    batched = insert_scheduled_record(masters, f"{PREFIX} Batched {size}", size)
+    batched.status = "Admitted"
+    with Stage("service_create_batched", size) as stage:
+        stage.measure(batched.save, ignore_permissions=True)
+    stages.append(stage)
+    assert_services(stage, batched)
+
+    per_row = insert_scheduled_record(masters, f"{PREFIX} Per Row {size}", size)
+    with Stage("service_create_per_row", size) as stage:
+        stage.measure(save_and_create_per_row, per_row)
+    stages.append(stage)
+    assert_services(stage, per_row)
+
+    return [stage.as_dict() for stage in stages]
+
+def insert_scheduled_record(masters, first_name, size):
+    patient = insert_patient(first_name)
+    inpatient_record = build_inpatient_record(masters, patient.name, size)
+    inpatient_record.status = "Admission Scheduled"
+    inpatient_record.insert(ignore_permissions=True)
+    return inpatient_record
+
+def save_and_create_per_row(inpatient_record):
+    # The record stays scheduled, so the save creates nothing and the old path does all the work
+    inpatient_record.save(ignore_permissions=True)
+    create_services_per_row(inpatient_record)
+
+def run_lab_tests(masters, count):
+    """
+    Times the save of an admission ordering `count` Lab Tests, which creates them with their
+    Service Requests and links them to one Specimen per sample.
+    """
+    patient = frappe.new_doc("Patient")
+    patient.first_name = f"{PREFIX} Lab Tests {count}"
+    patient.sex = "Male"
+    patient.insert(ignore_permissions=True)
+
+    inpatient_record = build_inpatient_record(masters, patient.name, 0)
+    for i in range(count):
+        template = masters.lab_templates[i % len(masters.lab_templates)]
+        inpatient_record.append("lab_test_prescription", {"lab_test_code": template, "lab_test_name": template})
+
+    with Stage("lab_test_run", count) as stage:
+        stage.measure(inpatient_record.insert, ignore_permissions=True)
+    assert_services(stage, inpatient_record)
+    return [stage.as_dict()]
+
+def assert_services(stage, inpatient_record, docstatus=0):
+    """
+    Fails the run unless every prescription of the record has a service with `docstatus`
+    and a submitted Service Request for it.
+    """
+    missing = []
+    for fieldname, service_doctype, _label, _name_field in SERVICE_TABLES:
+        expected = len(inpatient_record.get(fieldname) or [])
+        if not expected:
+            continue
+        services = frappe.get_all(
+            service_doctype,
+            filters={"inpatient_record": inpatient_record.name, "docstatus": docstatus},
+            pluck="name"
+        )
+        requests = frappe.db.count(
+            "Service Request", {"template_dt": service_doctype, "template_dn": ["in", services], "docstatus": 1}
+        ) if services else 0
+        if len(services) < expected:
+            missing.append(f"{expected - len(services)} {service_doctype}")
+        if requests < expected:
+            missing.append(f"{expected - requests} Service Request for {service_doctype}")
+
+    if missing:
+        frappe.throw(f"Stage {stage.name} at size {stage.size} is missing {', '.join(missing)}")
+
+def run_compaction(masters, lines):
+    """
+    Submits an invoice of `lines` single-quantity lines as is, and an identical one after compaction.
+    """
+    stages = []
+    customer = ensure_doc("Customer", f"{PREFIX} Customer", {
+        "customer_name": f"{PREFIX} Customer",
+        "customer_type": "Individual",
+    })
+
+    uncompacted = build_invoice(masters, customer, lines)
+    with Stage("invoice_submit", lines) as stage:
+        stage.measure(uncompacted.submit)
+    stages.append(stage)
+
+    compacted = build_invoice(masters, customer, lines)
+    with Stage("invoice_compact", lines) as stage:
+        stage.measure(compact_invoice, compacted.name)
+    stages.append(stage)
+
+    compacted.reload()
+    with Stage("invoice_submit_compacted", lines) as stage:
+        stage.measure(compacted.submit)
+    stages.append(stage)
+
+    return [stage.as_dict() for stage in stages]
+
+def run_duplicate_check(masters):
+    """
+    Times an uncached duplicate check of `DUPLICATE_CHECK_SERVICES` services grouped by doctype
+    and with a query per service, and fails the run if the grouped check needs more than
+    `DUPLICATE_CHECK_MAX_QUERIES` queries per call.
+    """
+    stages = []
+    patient = insert_patient(f"{PREFIX} Duplicate Check")
+    masters_by_type = (
+        ("Medication", masters.drugs),
+        ("Lab Test", masters.lab_templates),
+        ("Procedure", masters.procedure_templates),
+    )
+    services = []
+    for i in range(DUPLICATE_CHECK_SERVICES):
+        service_type, names = masters_by_type[i % len(masters_by_type)]
+        services.append({"service_type": service_type, "service_name": names[i // len(masters_by_type) % len(names)]})
+    # Loads the doctype metadata, so the stages only count the checks' own queries
+    check_duplicate_services(patient.name, services, use_cache=0)
+    check_duplicate_services_per_service(patient.name, services)
+
+    with Stage("duplicate_check_grouped", DUPLICATE_CHECK_SERVICES) as stage:
+        for _i in range(DUPLICATE_CHECK_RUNS):
+            stage.measure(check_duplicate_services, patient.name, services, use_cache=0)
+    stages.append(stage)
+    if stage.queries > DUPLICATE_CHECK_MAX_QUERIES * DUPLICATE_CHECK_RUNS:
+        frappe.throw(
+            f"A check of {DUPLICATE_CHECK_SERVICES} services took {stage.queries / DUPLICATE_CHECK_RUNS} queries, "
+            f"more than {DUPLICATE_CHECK_MAX_QUERIES}"
+        )
+
+    with Stage("duplicate_check_per_service", DUPLICATE_CHECK_SERVICES) as stage:
+        for _i in range(DUPLICATE_CHECK_RUNS):
+            stage.measure(check_duplicate_services_per_service, patient.name, services)
+    stages.append(stage)
+
+    return [stage.as_dict() for stage in stages]
+
+def run_price_lookup(masters):
+    """
+    Times `PRICE_LOOKUPS` rate reads of the lab templates and drugs from the in-process price
+    cache, from the site-wide tier with the in-process entry dropped before every read, and by
+    loading the whole document.
+    """
+    stages = []
+    lookups = [
+        ("Lab Test Template", masters.lab_templates[i % len(masters.lab_templates)]) if i % 2
+        else ("Item", masters.drugs[i % len(masters.drugs)])
+        for i in range(PRICE_LOOKUPS)
+    ]
+    for doctype, name in set(lookups):
+        get_rate(doctype, name)
+
+    with Stage("price_lookup_cached", PRICE_LOOKUPS) as stage:
+        for doctype, name in lookups:
+            stage.measure(get_rate, doctype, name)
+    stages.append(stage)
+
+    with Stage("price_lookup_site_tier", PRICE_LOOKUPS) as stage:
+        for doctype, name in lookups:
+            stage.measure(get_rate_from_site_tier, doctype, name)
+    stages.append(stage)
+
+    with Stage("price_lookup_get_doc", PRICE_LOOKUPS) as stage:
+        for doctype, name in lookups:
+            stage.measure(get_rate_from_doc, doctype, name)
+    stages.append(stage)
+
+    return [stage.as_dict() for stage in stages]
+
+def get_rate_from_site_tier(doctype, name):
+    price_cache.delete((frappe.local.site, doctype, name))
+    return get_rate(doctype, name)
+
+def run_stay(masters, lines):
+    """
+    Bills a stay of `lines` service charges on a patient of its own, once through the charge
+    accumulator and once with an invoice save per submit. The accumulator's flushes run in-process
+    when the threshold is reached, so their cost is part of the stage instead of a worker's.
+    """
+    stages = []
+
+    patient = insert_patient(f"{PREFIX} Stay {lines}")
+    with (
+        patch.object(charge_accumulator, "enqueue_flush", flush_pending_charges),
+        Stage("stay_billing_accumulated", lines) as stage,
+    ):
+        for i in range(lines):
+            drug = masters.drugs[i % len(masters.drugs)]
+            stage.measure(add_charge, patient.name, "Medication Request", f"{PREFIX}-STAY-{lines}-{i}", drug, 5, drug)
+        stage.measure(flush_pending_charges, patient.name)
+    stages.append(stage)
+    assert_invoice_lines(stage, patient.name, lines)
+
+    patient = insert_patient(f"{PREFIX} Stay Per Submit {lines}")
+    with Stage("stay_billing_per_submit", lines) as stage:
+        for i in range(lines):
+            drug = masters.drugs[i % len(masters.drugs)]
+            stage.measure(add_charge_per_submit, patient.customer, drug, 5, drug)
+    stages.append(stage)
+    assert_invoice_lines(stage, patient.name, lines)
+
+    return [stage.as_dict() for stage in stages]
+
+def insert_patient(first_name):
+    patient = frappe.new_doc("Patient")
+    patient.first_name = first_name
+    patient.sex = "Male"
+    return patient.insert(ignore_permissions=True)
+
+def assert_invoice_lines(stage, patient, lines):
+    """
+    Fails the run unless the patient's billing invoice holds `lines` charges besides its opening line.
+    """
+    invoice_name = frappe.db.get_value("Patient", patient, "custom_billing_invoice")
+    billed = frappe.db.count("Sales Invoice Item", {"parent": invoice_name}) - 1 if invoice_name else 0
+    if billed != lines:
+        frappe.throw(f"Stage {stage.name} at size {stage.size} billed {billed} of {lines} charges")
+
+def run_invoice_lookup(invoice_count):
+    """
+    Times finding a patient's draft invoice among `invoice_count` seeded Sales Invoices through
+    the patient's link and with the old customer scan. The scan runs on the current schema, so it
+    already has the (customer, docstatus) index; the link still saves it the secondary index read.
+    """
+    stages = []
+    seed_invoice_history(invoice_count)
+    patient = insert_patient(f"{PREFIX} Invoice Lookup {invoice_count}")
+
+    with Stage("invoice_lookup_linked", invoice_count) as stage:
+        for _i in range(HISTORY_LOOKUPS):
+            stage.measure(get_billing_invoice, patient.name)
+    stages.append(stage)
+
+    with Stage("invoice_lookup_customer_scan", invoice_count) as stage:
+        for _i in range(HISTORY_LOOKUPS):
+            stage.measure(get_draft_invoice_by_customer, patient.customer)
+    stages.append(stage)
+
+    if get_billing_invoice(patient.name) != get_draft_invoice_by_customer(patient.customer):
+        frappe.throw(f"The invoice lookups at size {invoice_count} disagree")
+
+    return [stage.as_dict() for stage in stages]
+
+def seed_invoice_history(count):
+    """
+    Bulk inserts `count` Sales Invoices of synthetic customers, mostly submitted, bypassing the
+    document hooks. Only the columns the lookups filter on are filled.
+    """
+    now, user = frappe.utils.now(), frappe.session.user
+    fields = ["name", "creation", "modified", "owner", "modified_by", "docstatus", "customer", "posting_date"]
+    for start in range(0, count, INVOICE_HISTORY_CHUNK):
+        frappe.db.bulk_insert("Sales Invoice", fields, [
+            (
+                f"{PREFIX}-SINV-{i}", now, now, user, user, 0 if i % 10 == 0 else 1,
+                f"{PREFIX} Invoice Customer {i % INVOICE_HISTORY_CUSTOMERS}", nowdate(),
+            )
+            for i in range(start, min(start + INVOICE_HISTORY_CHUNK, count))
+        ], chunk_size=INVOICE_HISTORY_CHUNK)
+
+def run_history(masters, history_size):
+    """
+    Times the duplicate check and the Service Request completion lookup for a patient whose
+    history holds `history_size` archived Lab Tests, each with its Service Request.
+    """
+    stages = []
+    patient = frappe.new_doc("Patient")
+    patient.first_name = f"{PREFIX} History {history_size}"
+    patient.sex = "Male"
+    patient.insert(ignore_permissions=True)
+    seed_archived_history(masters, patient.name, history_size)
+
+    services = [{"service_type": "Lab Test", "service_name": template} for template in masters.lab_templates]
+    with Stage("hot_duplicate_check", history_size) as stage:
+        for _i in range(HISTORY_LOOKUPS):
+            stage.measure(check_duplicate_services, patient.name, services, use_cache=0)
+    stages.append(stage)
+
+    with Stage("hot_service_request_lookup", history_size) as stage:
+        for i in range(HISTORY_LOOKUPS):
+            stage.measure(submit_or_update_service_request, patient.name, "Lab Test", f"{PREFIX}-LT-{i}")
+    stages.append(stage)
+
+    return [stage.as_dict() for stage in stages]
+
+def cleanup():
+    """
+    Deletes the patients of earlier runs with their services, charges, invoices and customers,
+    and the invoices of the compaction stage, then commits. Masters are kept.
+    """
+    patients = frappe.get_all("Patient", filters={"first_name": ["like", f"{PREFIX} %"]}, pluck="name")
+    customers = frappe.get_all("Customer", filters={"custom_patient": ["in", patients]}, pluck="name") if patients else []
+
+    invoices = frappe.get_all(
+        "Sales Invoice", filters={"customer": ["in", [*customers, f"{PREFIX} Customer"]]}, pluck="name"
+    )
+    if invoices:
+        for ledger in ("GL Entry", "Payment Ledger Entry"):
+            frappe.db.delete(ledger, {"voucher_type": "Sales Invoice", "voucher_no": ["in", invoices]})
+        delete_docs("Sales Invoice", invoices)
+    # The seeded invoice history has no child rows or ledger entries
+    frappe.db.delete("Sales Invoice", {"name": ["like", f"{PREFIX}-SINV-%"]})
+
+    if patients:
+        for doctype in PATIENT_DOCTYPES:
+            if frappe.db.has_column(doctype, "patient"):
+                delete_docs(doctype, frappe.get_all(doctype, filters={"patient": ["in", patients]}, pluck="name"))
+        delete_docs("Customer", customers)
+        delete_docs("Patient", patients)
+
+    frappe.db.commit()
+
+def delete_docs(doctype, names):
+    """
+    Deletes documents and their child rows in bulk, bypassing their hooks.
+    """
+    if not names:
+        return
+    for table_field in frappe.get_meta(doctype).get_table_fields():
+        frappe.db.delete(table_field.options, {"parenttype": doctype, "parent": ["in", names]})
+    frappe.db.delete(doctype, {"name": ["in", names]})
+
+def seed_archived_history(masters, patient, size):
+    """
+    Bulk inserts archived Lab Tests and their Service Requests, bypassing the document hooks.
+    """
+    now, user = frappe.utils.now(), frappe.session.user
+    base = ["name", "creation", "modified", "owner", "modified_by", "docstatus", "patient", "custom_archived"]
+    lab_tests = []
+    service_requests = []
+    for i in range(size):
+        lab_test = frappe.generate_hash()
+        template = masters.lab_templates[i % len(masters.lab_templates)]
+        lab_tests.append((lab_test, now, now, user, user, 1, patient, 1, template, "Completed"))
+        service_requests.append((frappe.generate_hash(), now, now, user, user, 1, patient, 1, "Lab Test", lab_test))
+
+    frappe.db.bulk_insert("Lab Test", [*base, "template", "status"], lab_tests)
+    frappe.db.bulk_insert("Service Request", [*base, "template_dt", "template_dn"], service_requests)
+
+def build_invoice(masters, customer, lines):
+    """
+    Inserts a draft invoice billing the same few drugs over and over, like a long stay.
+    """
+    si = make_billing_invoice(customer, [
+        {"item_code": masters.drugs[i % len(masters.drugs)], "qty": 1, "rate": 5 + i % len(masters.drugs)}
+        for i in range(lines)
+    ])
+    si.company = masters.company
+    si.insert(ignore_permissions=True)
+    return si
+
+def build_inpatient_record(masters, patient, size):
+    """
+    Builds an admitted Inpatient Record whose `size` prescriptions are spread
+    over the medication, lab test and procedure tables.
+    """
+    doc = frappe.new_doc("Inpatient Record")
+    doc.patient = patient
+    doc.company = masters.company
+    doc.status = "Admitted"
+    doc.primary_practitioner = masters.practitioner
+    doc.scheduled_date = nowdate()
+    doc.admitted_datetime = frappe.utils.now_datetime()
+
+    for i in range(size):
+        kind = i % 3
+        if kind == 0:
+            drug = masters.drugs[i % len(masters.drugs)]
+            doc.append("drug_prescription", {"drug_code": drug, "drug_name": drug, "dosage": "1", "period": "1 Day"})
+        elif kind == 1:
+            template = masters.lab_templates[i % len(masters.lab_templates)]
+            doc.append("lab_test_prescription", {"lab_test_code": template, "lab_test_name": template})
+        else:
+            template = masters.procedure_templates[i % len(masters.procedure_templates)]
+            doc.append("procedure_prescription", {"procedure": template, "procedure_name": template})
+
+    return doc
+
+def seed_masters():
+    """
+    Creates the items, templates, practitioner and Service Request status the synthetic hospital needs.
+    """
+    masters = frappe._dict(
+        company=frappe.defaults.get_user_default("Company") or frappe.db.get_value("Company", {}, "name"),
+        drugs=[],
+        lab_templates=[],
+        procedure_templates=[],
+    )
+
+    ensure_item("inpatient service", 0)
+    samples = [
+        ensure_doc("Lab Test Sample", f"{PREFIX} Sample {i}", {"sample": f"{PREFIX} Sample {i}"})
+        for i in range(SAMPLE_COUNT)
+    ]
+    for i in range(MASTER_COUNT):
+        masters.drugs.append(ensure_item(f"{PREFIX}-DRUG-{i}", 5 + i))
+
+        lab_item = ensure_item(f"{PREFIX}-LAB-{i}", 20 + i)
+        masters.lab_templates.append(ensure_doc("Lab Test Template", lab_item, {
+            "lab_test_name": lab_item,
+            "lab_test_code": lab_item,
+            "lab_test_template_type": "Single",
+            "lab_test_group": "Services",
+            "is_billable": 1,
+            "link_existing_item": 1,
+            "item": lab_item,
+            "lab_test_rate": 20 + i,
+            "sample": samples[i % SAMPLE_COUNT],
+        }))
+
+        procedure_item = ensure_item(f"{PREFIX}-PROC-{i}", 100 + i)
+        masters.procedure_templates.append(ensure_doc("Clinical Procedure Template", procedure_item, {
+            "template": procedure_item,
+            "item_code": procedure_item,
+            "item_group": "Services",
+            "is_billable": 1,
+            "link_existing_item": 1,
+            "item": procedure_item,
+            "rate": 100 + i,
+        }))
+
+    # Service Requests are created with this status; without it every service fails
+    if not frappe.db.exists("Code Value", {"code_value": "Draft"}):
+        ensure_doc("Code System", f"{PREFIX} Codes", {"code_system": f"{PREFIX} Codes"})
+        ensure_doc("Code Value", f"{PREFIX} Draft", {
+            "code_system": f"{PREFIX} Codes",
+            "code_value": "Draft",
+            "display": "Draft",
+        })
+
+    masters.practitioner = ensure_doc("Healthcare Practitioner", f"{PREFIX} Practitioner", {
+        "first_name": f"{PREFIX} Practitioner",
+    })
+    return masters
+
+def ensure_item(item_code, rate):
+    return ensure_doc("Item", item_code, {
+        "item_code": item_code,
+        "item_name": item_code,
+        "item_group": "Services",
+        "stock_uom": "Nos",
+        "is_stock_item": 0,
+        "valuation_rate": rate,
+    })
+
+def ensure_doc(doctype, name, values):
+    if frappe.db.exists(doctype, name):
+        return name
+    doc = frappe.get_doc({"doctype": doctype, **values})
+    doc.flags.ignore_mandatory = True
+    doc.insert(ignore_permissions=True, set_name=name)
+    return doc.name
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Returns the stages whose p95 latency or query count regressed against the baseline.
+    """
+    baseline_stages = {(row["stage"], row["size"]): row for row in baseline["results"]}
+    regressions = []
+    for row in results["results"]:
+        before = baseline_stages.get((row["stage"], row["size"]))
+        if not before:
+            continue
+        if before["p95_ms"] and row["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append({**row, "metric": "p95_ms", "baseline": before["p95_ms"]})
+        if row["queries"] > before["queries"]:
+            regressions.append({**row, "metric": "queries", "baseline": before["queries"]})
+    return regressions
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+def save_results(results, path):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=1)
@@ -0,0 +1,108 @@
+"""
+Reference implementations of the per-row code paths the app used before they were batched.
+
+They are kept only so the pipeline benchmark can time the current code against what it
+replaced on the same site and data; nothing in the app calls them.
+"""
+
+from datetime import datetime
+
+import frappe
+
+from custom_app.custom_app.inpatient_handler import (
+    DUPLICATE_CHECKS,
+    SERVICE_BUILDERS,
+    SERVICE_TABLES,
+    ServiceRunContext,
+)
+from custom_app.custom_app.service_item_details import RATE_FIELDS
+
+
+def create_services_per_row(doc):
+    """
+    Creates the services of every unlinked row the way `create_services` did before batching:
+    per row, one service insert, one `db_update` of the row and a Service Request that is
+    inserted, saved and submitted, each resolving the status and company again.
+    """
+    context = ServiceRunContext(doc, [])
+    for fieldname, service_doctype, _label, _name_field in SERVICE_TABLES:
+        for row in doc.get(fieldname) or []:
+            if row.custom_linked_document:
+                continue
+            service = frappe.get_doc(SERVICE_BUILDERS[service_doctype](doc, row, context))
+            service.insert(ignore_permissions=True)
+
+            row.custom_linked_document = service.name
+            row.db_update()
+
+            create_service_request_per_row(doc, service_doctype, service.name)
+
+def create_service_request_per_row(doc, service_doctype, service_name):
+    now = datetime.now()
+    service_request = frappe.get_doc({
+        "doctype": "Service Request",
+        "naming_series": "HSR-",
+        "order_date": now.date(),
+        "order_time": now.time().strftime("%H:%M:%S"),
+        "status": frappe.get_value("Code Value", {"code_value": "Draft"}, "name"),
+        "company": doc.company or frappe.defaults.get_user_default("Company"),
+        "patient": doc.patient,
+        "practitioner": doc.primary_practitioner,
+        "template_dt": service_doctype,
+        "template_dn": service_name,
+        "healthcare_service_unit_type": doc.admission_service_unit_type,
+        "source_doc": doc.doctype,
+        "referred_to_practitioner": doc.secondary_practitioner,
+        "expected_date": doc.expected_discharge,
+        "patient_care_type": "Diagnostic",
+        "occurrence_date": now.date()
+    })
+    service_request.insert(ignore_permissions=True)
+    service_request.save()
+    service_request.submit()
+
+def add_charge_per_submit(customer, item_code, rate, description):
+    """
+    Bills one submitted service the way the submit hooks did before the charge accumulator:
+    finds the customer's draft invoice, loads it whole, appends the line and saves it.
+    """
+    sales_invoices = frappe.get_all("Sales Invoice", filters={"customer": customer, "docstatus": 0})
+    sales_invoice = frappe.get_doc("Sales Invoice", sales_invoices[0].name)
+    sales_invoice.append("items", {
+        "item_code": item_code,
+        "qty": 1,
+        "rate": rate,
+        "description": description
+    })
+    sales_invoice.save()
+
+def get_draft_invoice_by_customer(customer):
+    """
+    Finds the patient's draft invoice the way the billing hooks did before the patient kept
+    a link to it: the first draft of the customer in whatever order the scan returns them.
+    """
+    sales_invoices = frappe.get_all("Sales Invoice", filters={"customer": customer, "docstatus": 0})
+    return sales_invoices[0].name if sales_invoices else None
+
+def check_duplicate_services_per_service(patient, services):
+    """
+    Checks every service for an existing document with a query of its own, the way
+    `check_duplicate_services` did before it grouped them by doctype.
+    """
+    duplicates = []
+    for service in services:
+        doctype, fieldname = DUPLICATE_CHECKS.get(service["service_type"], (None, None))
+        if doctype and frappe.get_all(doctype, filters={
+            "patient": patient,
+            fieldname: service["service_name"],
+            "docstatus": ["<", 2]
+        }, limit=1):
+            duplicates.append(service)
+    return duplicates
+
+def get_rate_from_doc(doctype, name):
+    """
+    Reads a template's or item's rate by loading the whole document, child tables included,
+    the way the billing hooks did before the price cache.
+    """
+    return frappe.get_doc(doctype, name).get(RATE_FIELDS[doctype])
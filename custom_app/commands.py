@@ -0,0 +1,144 @@
+import json
+import os
+
+import click
+import frappe
+from frappe.commands import get_site, pass_context
+
+
+@click.command("benchmark-billing-pipeline")
+@click.option("--sizes", default="1,10,100,500", help="Comma separated prescription counts per admission")
+@click.option("--output", help="Write the results as JSON to this file")
+@click.option("--baseline", help="Compare against results saved earlier and fail on regressions")
+@click.option("--tolerance", default=0.2, type=float, help="Allowed p95 latency growth over the baseline")
+@click.option(
+    "--lab-tests", default=200, type=int, help="Lab Tests ordered at once in the specimen grouping stage, 0 to skip"
+)
+@click.option("--invoice-lines", type=int, help="Also submit an invoice of this many lines before and after compaction")
+@click.option("--history", help="Comma separated archived history sizes to time the hot-path lookups against")
+@click.option(
+    "--stay-lines", help="Comma separated stay lengths to bill through the accumulator and per submit, e.g. 1000,5000,10000"
+)
+@click.option(
+    "--invoice-history", type=int, help="Seed this many Sales Invoices and time the draft invoice lookups against them"
+)
+@click.option("--keep-data", is_flag=True, default=False, help="Keep the patients and invoices the run created")
+@pass_context
+def benchmark_billing_pipeline(
+    context, sizes, output=None, baseline=None, tolerance=0.2, lab_tests=200, invoice_lines=None, history=None,
+    stay_lines=None, invoice_history=None, keep_data=False
+):
+    "Load test the clinical-to-billing hook chain on a test site"
+    from custom_app.benchmarks import pipeline
+
+    site = get_site(context)
+    frappe.init(site=site)
+    frappe.connect()
+    try:
+        results = pipeline.run(
+            [int(size) for size in sizes.split(",")],
+            lab_tests=lab_tests,
+            invoice_lines=invoice_lines,
+            history_sizes=[int(size) for size in history.split(",")] if history else None,
+            stay_lines=[int(lines) for lines in stay_lines.split(",")] if stay_lines else None,
+            invoice_history=invoice_history,
+            keep_data=keep_data,
+        )
+    finally:
+        frappe.destroy()
+
+    if output:
+        pipeline.save_results(results, output)
+    else:
+        click.echo(json.dumps(results, indent=1))
+
+    if baseline:
+        regressions = pipeline.compare(results, pipeline.load_results(baseline), tolerance)
+        for row in regressions:
+            click.secho(
+                f"{row['stage']} ({row['size']} rows): {row['metric']} {row[row['metric']]} "
+                f"vs baseline {row['baseline']}",
+                fg="red",
+            )
+        if regressions:
+            raise SystemExit(1)
+
+
+@click.command("benchmark-imports")
+@click.option("--repeat", default=5, type=int, help="Fresh interpreters started per target")
+@click.option("--output", help="Write the results as JSON to this file")
+@click.option(
+    "--entry-module",
+    default="custom_app.custom_app.events",
+    help="Module imported before every target, as the hooks resolve it; pass an empty string to import the targets alone",
+)
+def benchmark_imports(repeat=5, output=None, entry_module="custom_app.custom_app.events"):
+    "Measure the import time and memory a cold worker pays for the app's hook modules"
+    from custom_app.benchmarks import imports
+
+    results = imports.run(repeat, entry_module=entry_module)
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=1)
+    else:
+        click.echo(json.dumps(results, indent=1))
+
+
+@click.command("import-patients")
+@click.argument("path")
+@click.option("--chunk-size", default=500, type=int, help="Patients imported per transaction")
+@click.option("--workers", default=1, type=int, help="Number of processes importing chunks in parallel")
+@click.option("--checkpoint", help="Checkpoint file, defaults to PATH.checkpoint")
+@pass_context
+def import_patients(context, path, chunk_size=500, workers=1, checkpoint=None):
+    "Import patients and their open charges from a CSV or JSONL file"
+    from custom_app.custom_app import patient_import
+
+    site = get_site(context)
+    frappe.init(site=site)
+    frappe.connect()
+    try:
+        totals = patient_import.import_patients(
+            os.path.abspath(path), chunk_size=chunk_size, workers=workers, checkpoint_path=checkpoint
+        )
+    finally:
+        frappe.destroy()
+
+    click.echo(
+        f"Imported {totals['patients']} patients in {totals['chunks']} chunks "
+        f"({totals['customers']} customers and {totals['invoices']} invoices created, "
+        f"{totals['skipped']} existing patients skipped)"
+    )
+
+
+@click.command("rebuild-billing-summary")
+@click.option("--patient", help="Only rebuild the summaries of this patient")
+@click.option("--check", is_flag=True, default=False, help="Only report the summaries that are out of date")
+@pass_context
+def rebuild_billing_summary(context, patient=None, check=False):
+    "Recompute the inpatient billing summaries from the posted charges"
+    from custom_app.custom_app import billing_summary
+
+    site = get_site(context)
+    frappe.init(site=site)
+    frappe.connect()
+    try:
+        mismatched, unreconcilable = billing_summary.rebuild_summaries(patient, check_only=check)
+    finally:
+        frappe.destroy()
+
+    for name in mismatched:
+        click.echo(name)
+    click.echo(f"{len(mismatched)} summaries {'out of date' if check else 'rebuilt'}")
+    for name in unreconcilable:
+        click.secho(name, fg="yellow")
+    if unreconcilable:
+        click.secho(
+            f"{len(unreconcilable)} summaries unreconcilable: their patient has invoice lines billed without a charge",
+            fg="yellow",
+        )
+    if check and (mismatched or unreconcilable):
+        raise SystemExit(1)
+
+
+commands = [benchmark_billing_pipeline, benchmark_imports, import_patients, rebuild_billing_summary]
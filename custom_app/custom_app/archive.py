@@ -0,0 +1,137 @@
+"""
+Hot/cold split of the service documents.
+
+Once an admission is discharged and fully billed, its Medication Requests, Lab Tests, Clinical
+Procedures and their Service Requests are flagged `custom_archived`. They stay in their tables,
+so forms, reports and links keep working, but the hot-path lookups by patient (duplicate checks,
+Service Request completion) only read unarchived documents, through indexes that lead with the
+patient and the flag. A scheduled job archives admissions in batches; `get_service_history`
+reads both sets for history views.
+"""
+
+import frappe
+from frappe import _
+from frappe.utils import add_days, cint, now_datetime
+
+# Service doctypes archived with their admission; each links to it through `inpatient_record`
+SERVICE_DOCTYPES = ("Medication Request", "Lab Test", "Clinical Procedure")
+
+# Admissions archived per transaction, and batches per scheduled run
+ARCHIVE_BATCH_SIZE = 100
+MAX_BATCHES_PER_RUN = 10
+
+# Admissions are archived this many days after discharge.
+# Override with `custom_app_archive_after_days` in the site config.
+DEFAULT_ARCHIVE_AFTER_DAYS = 30
+
+# Columns returned by the history view of each doctype
+HISTORY_FIELDS = {
+    "Service Request": ["template_dt", "template_dn", "status", "order_date"],
+    "Medication Request": ["medication_item", "status", "inpatient_record"],
+    "Lab Test": ["template", "status", "inpatient_record"],
+    "Clinical Procedure": ["procedure_template", "status", "inpatient_record"],
+}
+
+
+def archive_discharged_admissions():
+    """
+    Archives discharged, fully billed admissions in batches, committing each batch.
+    Returns the number of admissions archived.
+    """
+    archived = 0
+    for _batch in range(MAX_BATCHES_PER_RUN):
+        admissions = get_archivable_admissions(ARCHIVE_BATCH_SIZE)
+        if not admissions:
+            break
+        archive_admissions(admissions)
+        frappe.db.commit()
+        archived += len(admissions)
+    return archived
+
+def get_archivable_admissions(limit):
+    """
+    Returns `(name, patient)` of admissions discharged long enough ago whose every charge is
+    posted to a submitted invoice and that have no draft service left: a draft is still to be
+    submitted and charged, and would drop out of the duplicate checks once archived.
+    """
+    cutoff = add_days(now_datetime(), -cint(
+        frappe.conf.get("custom_app_archive_after_days") or DEFAULT_ARCHIVE_AFTER_DAYS
+    ))
+    no_draft_services = "".join(
+        f"""
+            and not exists (
+                select 1 from `tab{service_doctype}` service
+                where service.inpatient_record = ir.name and service.docstatus = 0
+            )"""
+        for service_doctype in SERVICE_DOCTYPES
+        if frappe.db.has_column(service_doctype, "inpatient_record")
+    )
+    return frappe.db.sql(
+        f"""
+        select ir.name, ir.patient
+        from `tabInpatient Record` ir
+        where ir.status = 'Discharged'
+            and ir.custom_archived = 0
+            and ir.discharge_datetime < %(cutoff)s
+            and not exists (
+                select 1
+                from `tabPending Charge` charge
+                left join `tabSales Invoice` si on si.name = charge.sales_invoice
+                where charge.inpatient_record = ir.name
+                    and (charge.status != 'Posted' or si.docstatus is null or si.docstatus != 1)
+            ){no_draft_services}
+        order by ir.discharge_datetime
+        limit %(limit)s
+        """,
+        {"cutoff": cutoff, "limit": limit},
+        as_dict=True,
+    )
+
+def archive_admissions(admissions):
+    """
+    Flags the services of the admissions, their Service Requests and the admissions themselves
+    as archived, with one update per doctype.
+    """
+    from custom_app.custom_app.inpatient_handler import get_duplicate_cache_key
+
+    names = [admission.name for admission in admissions]
+    patients = list({admission.patient for admission in admissions})
+
+    for service_doctype in SERVICE_DOCTYPES:
+        if not frappe.db.has_column(service_doctype, "inpatient_record"):
+            continue
+        services = frappe.get_all(
+            service_doctype, filters={"inpatient_record": ["in", names], "custom_archived": 0}, pluck="name"
+        )
+        if not services:
+            continue
+        frappe.db.set_value(
+            service_doctype, {"name": ["in", services]}, "custom_archived", 1, update_modified=False
+        )
+        frappe.db.set_value(
+            "Service Request",
+            {"patient": ["in", patients], "template_dt": service_doctype, "template_dn": ["in", services]},
+            "custom_archived", 1, update_modified=False
+        )
+
+    frappe.db.set_value("Inpatient Record", {"name": ["in", names]}, "custom_archived", 1, update_modified=False)
+
+    for patient in patients:
+        frappe.cache().delete_value(get_duplicate_cache_key(patient))
+
+@frappe.whitelist()
+def get_service_history(patient, doctype, start=0, page_length=50):
+    """
+    Returns the patient's documents of one service doctype, archived or not, newest first.
+    """
+    if doctype not in HISTORY_FIELDS:
+        frappe.throw(_("History is not available for {0}").format(doctype))
+
+    return frappe.get_list(
+        doctype,
+        filters={"patient": patient},
+        fields=["name", "docstatus", "creation", "custom_archived", *HISTORY_FIELDS[doctype]],
+        order_by="creation desc",
+        start=cint(start),
+        page_length=cint(page_length)
+    )
@@ -0,0 +1,219 @@
+"""
+Running billing totals per admission.
+
+Every posted charge is added to the **Inpatient Billing Summary** of its admission (or of its
+patient, for charges outside an admission) in the transaction that appends it to the invoice,
+so dashboards read one row instead of summing every line of the draft invoices.
+`rebuild_summaries` recomputes the totals from the posted charges, to backfill or to check them.
+Lines billed without a charge, before the charge outbox or by the patient import, cannot be
+attributed to an admission, so the summaries of those patients are reported instead:
+
+    bench --site site1 rebuild-billing-summary --check
+"""
+
+import frappe
+from frappe import _
+from frappe.utils import flt
+
+# Summary column the charges of each service doctype add up to
+CATEGORY_FIELDS = {
+    "Lab Test": "lab_total",
+    "Medication Request": "medication_total",
+    "Clinical Procedure": "procedure_total",
+    # Encounter prescriptions are charged per row
+    "Drug Prescription": "medication_total",
+    "Lab Prescription": "lab_total",
+    "Procedure Prescription": "procedure_total",
+}
+
+TOTAL_FIELDS = ("lab_total", "medication_total", "procedure_total", "total_amount", "line_count")
+
+# Item of the line every billing invoice is opened with; it bills no service
+OPENING_ITEM = "inpatient service"
+
+
+def get_summary_name(patient, inpatient_record=None):
+    """
+    Summaries are named after their admission; charges outside an admission are summed per patient.
+    """
+    return inpatient_record or patient
+
+def new_totals(patient, inpatient_record=None):
+    totals = frappe._dict(patient=patient, inpatient_record=inpatient_record, last_charge_on=None)
+    totals.update({fieldname: 0 for fieldname in TOTAL_FIELDS})
+    return totals
+
+def add_to_totals(totals, service_doctype, amount, lines=1):
+    category_field = CATEGORY_FIELDS.get(service_doctype)
+    if category_field:
+        totals[category_field] += amount
+    totals.total_amount += amount
+    totals.line_count += lines
+
+def apply_charges(charges, posted_on):
+    """
+    Adds posted charges to their summaries with one atomic update per summary. Called while the
+    invoice lock is held, so the totals commit or roll back together with the invoice lines.
+    `charges` need `patient`, `inpatient_record`, `service_doctype`, `qty` and `rate`.
+    """
+    deltas = {}
+    for charge in charges:
+        name = get_summary_name(charge.patient, charge.inpatient_record)
+        if name not in deltas:
+            deltas[name] = new_totals(charge.patient, charge.inpatient_record)
+        add_to_totals(deltas[name], charge.service_doctype, flt(charge.qty) * flt(charge.rate))
+
+    for name, delta in deltas.items():
+        delta.last_charge_on = posted_on
+        increment_summary(name, delta)
+
+def increment_summary(name, delta):
+    if not frappe.db.exists("Inpatient Billing Summary", name):
+        try:
+            insert_summary(name, delta)
+            return
+        except frappe.DuplicateEntryError:
+            # Created by a concurrent flush for another invoice of the same admission
+            pass
+
+    frappe.db.sql(
+        """
+        update `tabInpatient Billing Summary`
+        set lab_total = lab_total + %(lab_total)s,
+            medication_total = medication_total + %(medication_total)s,
+            procedure_total = procedure_total + %(procedure_total)s,
+            total_amount = total_amount + %(total_amount)s,
+            line_count = line_count + %(line_count)s,
+            last_charge_on = greatest(coalesce(last_charge_on, %(last_charge_on)s), %(last_charge_on)s),
+            modified = %(last_charge_on)s
+        where name = %(name)s
+        """,
+        {**delta, "name": name},
+    )
+
+def insert_summary(name, totals):
+    summary = frappe.get_doc({"doctype": "Inpatient Billing Summary", **totals})
+    summary.insert(ignore_permissions=True, set_name=name)
+
+def rebuild_summaries(patient=None, check_only=False):
+    """
+    Recomputes the summaries from the posted charges, one patient per transaction, and returns
+    `(mismatched, unreconcilable)`: the names whose stored totals were wrong or missing, and the
+    names of the summaries that cannot be recomputed, because their patient has invoice lines no
+    charge points at. A patient of the latter without any summary is reported by name.
+    Those summaries are never rewritten. With `check_only` nothing is written.
+    Charges posted while a patient is being rebuilt are reported by the next check.
+    """
+    conditions = "where status = 'Posted'"
+    values = {}
+    if patient:
+        conditions += " and patient = %(patient)s"
+        values["patient"] = patient
+
+    expected = {}
+    for row in frappe.db.sql(
+        f"""
+        select patient, inpatient_record, service_doctype,
+            count(name) as line_count, sum(qty * rate) as amount, max(posted_on) as last_charge_on
+        from `tabPending Charge`
+        {conditions}
+        group by patient, inpatient_record, service_doctype
+        """,
+        values,
+        as_dict=True,
+    ):
+        name = get_summary_name(row.patient, row.inpatient_record)
+        if name not in expected:
+            expected[name] = new_totals(row.patient, row.inpatient_record)
+        totals = expected[name]
+        add_to_totals(totals, row.service_doctype, flt(row.amount), row.line_count)
+        if not totals.last_charge_on or row.last_charge_on > totals.last_charge_on:
+            totals.last_charge_on = row.last_charge_on
+
+    stored = {
+        row.name: row
+        for row in frappe.get_all(
+            "Inpatient Billing Summary",
+            filters={"patient": patient} if patient else {},
+            fields=["name", "patient", "inpatient_record", "last_charge_on", *TOTAL_FIELDS],
+        )
+    }
+
+    unreconcilable_patients = set(get_patients_with_unmatched_lines(patient))
+    unreconcilable = set()
+    names_by_patient = {}
+    for name in set(expected) | set(stored):
+        totals = expected.get(name) or new_totals(stored[name].patient, stored[name].inpatient_record)
+        if totals.patient in unreconcilable_patients:
+            unreconcilable.add(name)
+            unreconcilable_patients.discard(totals.patient)
+        elif name not in stored or not totals_match(totals, stored[name]):
+            names_by_patient.setdefault(totals.patient, []).append((name, totals))
+    unreconcilable |= unreconcilable_patients
+
+    mismatched = []
+    for summaries in names_by_patient.values():
+        for name, totals in summaries:
+            mismatched.append(name)
+            if check_only:
+                continue
+            if name in stored:
+                frappe.db.set_value(
+                    "Inpatient Billing Summary", name,
+                    {fieldname: totals[fieldname] for fieldname in (*TOTAL_FIELDS, "last_charge_on")}
+                )
+            else:
+                insert_summary(name, totals)
+        if not check_only:
+            frappe.db.commit()
+
+    return sorted(mismatched), sorted(unreconcilable)
+
+def get_patients_with_unmatched_lines(patient=None):
+    """
+    Returns the patients whose live Sales Invoices hold a line, other than the opening one,
+    that no Pending Charge points at.
+    """
+    conditions = ""
+    values = {"opening_item": OPENING_ITEM}
+    if patient:
+        conditions = "and customer.custom_patient = %(patient)s"
+        values["patient"] = patient
+
+    return frappe.db.sql_list(
+        f"""
+        select distinct customer.custom_patient
+        from `tabSales Invoice Item` item
+        join `tabSales Invoice` invoice on invoice.name = item.parent
+        join `tabCustomer` customer on customer.name = invoice.customer
+        where customer.custom_patient is not null {conditions}
+            and invoice.docstatus < 2
+            and item.parenttype = 'Sales Invoice'
+            and item.item_code != %(opening_item)s
+            and not exists (
+                select 1 from `tabPending Charge` charge where charge.sales_invoice_item = item.name
+            )
+        """,
+        values,
+    )
+
+def totals_match(expected, stored):
+    return all(flt(expected[fieldname], 2) == flt(stored[fieldname], 2) for fieldname in TOTAL_FIELDS)
+
+@frappe.whitelist()
+def get_billing_summary(inpatient_record=None, patient=None):
+    """
+    Returns the running totals of an admission, or of a patient's charges outside admissions,
+    with a single primary key lookup.
+    """
+    name = get_summary_name(patient, inpatient_record)
+    if not name:
+        frappe.throw(_("An Inpatient Record or a Patient is required."))
+    frappe.has_permission("Inpatient Billing Summary", "read", throw=True)
+
+    summary = frappe.db.get_value(
+        "Inpatient Billing Summary", name,
+        ["patient", "inpatient_record", "last_charge_on", *TOTAL_FIELDS],
+        as_dict=True
+    )
+    return summary or new_totals(patient, inpatient_record)
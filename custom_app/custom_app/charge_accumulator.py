@@ -0,0 +1,364 @@
+import random
+import time
+
+import frappe
+from frappe import _
+from frappe.utils import now_datetime, time_diff_in_seconds
+
+from custom_app.custom_app.billing_summary import apply_charges
+from custom_app.custom_app.error_aggregator import report_error
+
+# Number of pending charges for one patient that triggers an immediate flush.
+# Override with `custom_app_charge_flush_threshold` in the site config.
+DEFAULT_FLUSH_THRESHOLD = 20
+
+# Upper bound of charges posted by one scheduled flush
+FLUSH_BATCH_SIZE = 5000
+
+# Posting to an invoice is retried this many times when it loses a race with another writer
+MAX_POST_ATTEMPTS = 5
+
+# Base of the exponential backoff between attempts, in seconds; each wait is jittered
+RETRY_BASE_DELAY = 0.05
+
+RETRYABLE_ERRORS = (frappe.QueryDeadlockError, frappe.QueryTimeoutError, frappe.TimestampMismatchError)
+
+# Charges that failed to post this many times are parked as Failed until replayed
+MAX_DELIVERY_ATTEMPTS = 5
+
+# Error of the charges parked because their patient has no draft invoice to post to
+NO_INVOICE_ERROR = "The patient has no draft Sales Invoice"
+
+
+def add_charge(
+    patient, service_doctype, service_name, item_code, rate, description=None, qty=1, inpatient_record=None
+):
+    """
+    Records a charge for the patient's draft Sales Invoice in the outbox. It is written in the
+    transaction of the clinical submit, and posted later together with others, so one invoice
+    save covers many charges and invoice validation stays out of the clinician's path.
+    A service is charged at most once. Charges of an admission carry its `inpatient_record`,
+    which the billing summary totals them by.
+    """
+    if frappe.db.exists("Pending Charge", {"service_doctype": service_doctype, "service_name": service_name}):
+        return
+
+    frappe.get_doc({
+        "doctype": "Pending Charge",
+        "patient": patient,
+        "service_doctype": service_doctype,
+        "service_name": service_name,
+        "inpatient_record": inpatient_record,
+        "item_code": item_code,
+        "description": description,
+        "qty": qty,
+        "rate": rate,
+    }).insert(ignore_permissions=True)
+
+    if frappe.db.count("Pending Charge", {"patient": patient, "status": "Pending"}) >= get_flush_threshold():
+        enqueue_flush(patient)
+
+def add_charges(patient, charges, inpatient_record=None, flush=False):
+    """
+    Records many charges of one patient in the outbox with a single insert. `charges` are dicts
+    with `service_doctype`, `service_name`, `item_code`, `rate` and optionally `description`, `qty`
+    and `order_reference`, the request the charged line ordered.
+    Services already charged are skipped. With `flush`, the patient's charges are posted right
+    after commit whatever the threshold. Returns the number of charges recorded.
+    """
+    if not charges:
+        return 0
+
+    charged = set(frappe.get_all(
+        "Pending Charge",
+        filters={
+            "service_doctype": ["in", list({charge["service_doctype"] for charge in charges})],
+            "service_name": ["in", [charge["service_name"] for charge in charges]],
+        },
+        fields=["service_doctype", "service_name"],
+        as_list=True
+    ))
+    charges = [charge for charge in charges if (charge["service_doctype"], charge["service_name"]) not in charged]
+    if not charges:
+        return 0
+
+    now, user = frappe.utils.now(), frappe.session.user
+    fields = [
+        "name", "creation", "modified", "owner", "modified_by", "docstatus", "status", "attempts",
+        "patient", "inpatient_record", "order_reference", "service_doctype", "service_name",
+        "item_code", "description", "qty", "rate",
+    ]
+    frappe.db.bulk_insert("Pending Charge", fields, [
+        (
+            frappe.generate_hash(), now, now, user, user, 0, "Pending", 0,
+            patient, inpatient_record, charge.get("order_reference"), charge["service_doctype"], charge["service_name"],
+            charge["item_code"], charge.get("description"), charge.get("qty") or 1, charge["rate"] or 0,
+        )
+        for charge in charges
+    ])
+
+    if flush or frappe.db.count("Pending Charge", {"patient": patient, "status": "Pending"}) >= get_flush_threshold():
+        enqueue_flush(patient)
+    return len(charges)
+
+def enqueue_flush(patient):
+    # Posted in a job of its own, so billing contention can never roll back the clinical submit
+    frappe.enqueue(
+        "custom_app.custom_app.charge_accumulator.flush_pending_charges",
+        queue="short",
+        job_id=f"flush_pending_charges::{patient}",
+        deduplicate=True,
+        enqueue_after_commit=True,
+        patient=patient
+    )
+
+def get_flush_threshold():
+    return frappe.conf.get("custom_app_charge_flush_threshold") or DEFAULT_FLUSH_THRESHOLD
+
+def flush_pending_charges(patient=None):
+    """
+    Drains the outbox: posts pending charges to their draft Sales Invoices, saving each invoice
+    once for all of its charges. Runs from the scheduler for every patient, on demand, or for one
+    patient when its threshold is reached, and can be called directly to drain in-process.
+    Each invoice is posted and committed in its own transaction. Returns the number of charges posted.
+    """
+    filters = {"status": "Pending"}
+    if patient:
+        filters["patient"] = patient
+
+    charges = frappe.get_all(
+        "Pending Charge",
+        filters=filters,
+        fields=["name", "patient"],
+        order_by="creation asc",
+        limit=FLUSH_BATCH_SIZE
+    )
+    if not charges:
+        return 0
+
+    invoices = dict(frappe.get_all(
+        "Patient",
+        filters={"name": ["in", list({charge.patient for charge in charges})]},
+        fields=["name", "custom_billing_invoice"],
+        as_list=True
+    ))
+
+    charges_by_invoice = {}
+    unbilled = []
+    for charge in charges:
+        invoice_name = invoices.get(charge.patient)
+        if not invoice_name:
+            unbilled.append(charge)
+            continue
+        charges_by_invoice.setdefault(invoice_name, []).append(charge.name)
+
+    if unbilled:
+        park_unbilled_charges(unbilled)
+
+    posted = 0
+    for invoice_name, charge_names in charges_by_invoice.items():
+        try:
+            posted += post_charges(invoice_name, charge_names)
+        except Exception:
+            frappe.db.rollback()
+            report_error(_("Error posting charges"))
+            posted += isolate_failed_charges(invoice_name, charge_names, frappe.get_traceback())
+
+    return posted
+
+def isolate_failed_charges(invoice_name, charge_names, error):
+    """
+    Posts the charges of a group that failed one at a time, so only the charges that fail
+    on their own are counted as failed. Returns the number of charges posted.
+    """
+    if len(charge_names) == 1:
+        record_failed_delivery(charge_names, error)
+        return 0
+
+    posted = 0
+    for charge_name in charge_names:
+        try:
+            posted += post_charges(invoice_name, [charge_name])
+        except Exception:
+            frappe.db.rollback()
+            record_failed_delivery([charge_name], frappe.get_traceback())
+    return posted
+
+def park_unbilled_charges(charges):
+    """
+    Parks the charges of patients without a draft invoice, so they neither hold up the drain
+    nor wait unnoticed. They return to the outbox once the patient gets a billing invoice again.
+    """
+    frappe.db.set_value(
+        "Pending Charge",
+        {"name": ["in", [charge.name for charge in charges]]},
+        {"status": "Failed", "last_error": NO_INVOICE_ERROR},
+        update_modified=False
+    )
+    frappe.db.commit()
+    frappe.logger().warning(
+        f"{len(charges)} charge(s) parked, no draft Sales Invoice for patient(s) "
+        + ", ".join(sorted({charge.patient for charge in charges}))
+    )
+
+def requeue_unbilled_charges(patient):
+    """
+    Returns the charges parked for want of an invoice to the outbox, once the patient has one.
+    """
+    names = frappe.get_all(
+        "Pending Charge",
+        filters={"patient": patient, "status": "Failed", "last_error": NO_INVOICE_ERROR},
+        pluck="name"
+    )
+    if not names:
+        return 0
+    frappe.db.set_value(
+        "Pending Charge", {"name": ["in", names]}, {"status": "Pending", "attempts": 0, "last_error": None}
+    )
+    enqueue_flush(patient)
+    return len(names)
+
+def record_failed_delivery(charge_names, error):
+    """
+    Counts a failed attempt on the charges and parks those that keep failing.
+    """
+    frappe.db.sql(
+        """
+        update `tabPending Charge`
+        set attempts = attempts + 1,
+            last_error = %(error)s,
+            status = case when attempts >= %(max_attempts)s then 'Failed' else status end
+        where name in %(names)s and status = 'Pending'
+        """,
+        {"error": error[-1000:], "max_attempts": MAX_DELIVERY_ATTEMPTS, "names": tuple(charge_names)},
+    )
+    frappe.db.commit()
+
+def post_charges(invoice_name, charge_names):
+    """
+    Posts the given charges to one invoice and commits.
+    """
+    return retry_on_contention(append_charges, invoice_name, charge_names)
+
+def retry_on_contention(fn, *args):
+    """
+    Runs a write to an invoice and commits, retrying with jittered exponential
+    backoff when another writer holds or changed the invoice.
+    """
+    for attempt in range(1, MAX_POST_ATTEMPTS + 1):
+        try:
+            result = fn(*args)
+            frappe.db.commit()
+            return result
+
+        except RETRYABLE_ERRORS:
+            frappe.db.rollback()
+            if attempt == MAX_POST_ATTEMPTS:
+                raise
+            time.sleep(random.uniform(0, RETRY_BASE_DELAY * 2 ** attempt))
+
+def append_charges(invoice_name, charge_names):
+    """
+    Appends the charges still pending to the invoice while holding its row lock.
+    The billing summaries of the charges are updated in the same transaction.
+    Each charge records the invoice line it was posted as.
+    """
+    sales_invoice = lock_invoice(invoice_name)
+
+    # Re-read under the lock: a concurrent flush may already have posted some of them
+    charges = frappe.db.sql(
+        """
+        select name, patient, inpatient_record, service_doctype, item_code, qty, rate, description
+        from `tabPending Charge`
+        where name in %(names)s and status = 'Pending'
+        order by creation asc
+        for update
+        """,
+        {"names": tuple(charge_names)},
+        as_dict=True,
+    )
+    if not charges:
+        return 0
+
+    items = {}
+    for charge in charges:
+        items[charge.name] = sales_invoice.append("items", {
+            "item_code": charge.item_code,
+            "qty": charge.qty,
+            "rate": charge.rate,
+            "description": charge.description
+        })
+    sales_invoice.save(ignore_permissions=True)
+
+    posted_on = now_datetime()
+    frappe.db.bulk_update("Pending Charge", {
+        charge.name: {
+            "status": "Posted",
+            "sales_invoice": sales_invoice.name,
+            "sales_invoice_item": items[charge.name].name,
+            "posted_on": posted_on,
+        }
+        for charge in charges
+    })
+    apply_charges(charges, posted_on)
+    frappe.logger().info(f"{len(charges)} charge(s) posted to Sales Invoice {sales_invoice.name}")
+    return len(charges)
+
+def lock_invoice(invoice_name):
+    """
+    Returns the invoice holding its row lock until commit. The lock is taken first and the
+    invoice loaded once under it, so no other writer can change it in between.
+    """
+    # SELECT ... FOR UPDATE serializes every write to this invoice until commit
+    frappe.db.get_value("Sales Invoice", invoice_name, "name", for_update=True)
+    return frappe.get_doc("Sales Invoice", invoice_name)
+
+@frappe.whitelist()
+def flush_patient_charges(patient):
+    """
+    Posts the patient's pending charges right away, e.g. before printing the bill.
+    """
+    frappe.has_permission("Sales Invoice", "write", throw=True)
+    posted = flush_pending_charges(patient)
+    frappe.msgprint(_("{0} charge(s) posted to the Sales Invoice.").format(posted))
+    return posted
+
+@frappe.whitelist()
+def replay_failed_charges(patient=None):
+    """
+    Returns parked charges to the outbox so the next drain posts them again.
+    """
+    frappe.has_permission("Sales Invoice", "write", throw=True)
+
+    filters = {"status": "Failed"}
+    if patient:
+        filters["patient"] = patient
+    names = frappe.get_all("Pending Charge", filters=filters, pluck="name")
+    if names:
+        frappe.db.set_value("Pending Charge", {"name": ["in", names]}, {"status": "Pending", "attempts": 0})
+    return len(names)
+
+@frappe.whitelist()
+def get_outbox_metrics():
+    """
+    Returns the outbox backlog and lag: how many charges wait to be posted or are parked,
+    and how long the oldest pending charge has been waiting.
+    """
+    frappe.has_permission("Pending Charge", "read", throw=True)
+
+    counts = dict(frappe.get_all(
+        "Pending Charge", fields=["status", "count(name) as count"], group_by="status", as_list=True
+    ))
+    oldest_pending = frappe.db.get_value(
+        "Pending Charge", {"status": "Pending"}, "creation", order_by="creation asc"
+    )
+    last_posted = frappe.db.get_value(
+        "Pending Charge", {"status": "Posted"}, "posted_on", order_by="posted_on desc"
+    )
+    return {
+        "backlog": counts.get("Pending", 0),
+        "failed": counts.get("Failed", 0),
+        "posted": counts.get("Posted", 0),
+        "lag_seconds": time_diff_in_seconds(now_datetime(), oldest_pending) if oldest_pending else 0,
+        "last_posted_on": last_posted,
+    }
@@ -0,0 +1,17 @@
+# Copyright (c) 2026, Mortatha Mohammed and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+
+class PendingCharge(Document):
+    pass
+
+
+def on_doctype_update():
+    # A service is charged at most once; the drain reads the oldest pending charges first
+    frappe.db.add_unique(
+        "Pending Charge", ["service_doctype", "service_name"], constraint_name="unique_pending_charge_service"
+    )
+    frappe.db.add_index("Pending Charge", ["status", "creation"])
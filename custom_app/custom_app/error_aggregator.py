@@ -0,0 +1,192 @@
+"""
+Aggregation of service creation and billing failures.
+
+A misconfigured template fails the same way on every save of every admission, so logging each
+failure as its own Error Log floods the table with identical tracebacks. Failures are instead
+fingerprinted by exception type, code location and template, and pushed to a Redis buffer that
+is flushed in bulk into one **Service Error** per fingerprint, with its count and first and last
+occurrence. A full traceback is kept as an Error Log at most once per fingerprint per window.
+
+The buffer is drained atomically, so concurrent flushes never read the same failures, and each
+aggregate is upserted, so two flushes creating the same Service Error add up instead of failing.
+"""
+
+import hashlib
+import json
+import sys
+import time
+import traceback
+from datetime import datetime
+
+import frappe
+
+BUFFER_KEY = "custom_app:error_buffer"
+
+# The buffer is flushed as soon as it holds this many failures, and by the scheduler otherwise
+FLUSH_THRESHOLD = 500
+
+# At most one Error Log is written per fingerprint in this many seconds.
+# Override with `custom_app_error_log_window` in the site config.
+DEFAULT_ERROR_LOG_WINDOW = 60 * 60
+
+APP_PATH = "/custom_app/"
+
+
+def report_error(title, template=None):
+    """
+    Records the exception being handled. Must be called from an `except` block; writes nothing
+    to the database, so it is safe right after a rollback.
+    """
+    exc_type, exc, tb = sys.exc_info()
+    location = get_location(tb)
+    fingerprint = get_fingerprint(exc_type, location, template)
+    entry = {
+        "fingerprint": fingerprint,
+        "title": title,
+        "exception_type": exc_type.__name__ if exc_type else None,
+        "location": location,
+        "template": template,
+        "timestamp": time.time(),
+        "traceback": None,
+    }
+
+    cache = frappe.cache()
+    try:
+        # SET NX: only the first report of the window, across all workers, keeps its traceback
+        window_key = cache.make_key(f"custom_app:error_logged:{fingerprint}")
+        if cache.set(window_key, 1, ex=get_error_log_window(), nx=True):
+            entry["traceback"] = frappe.get_traceback()
+
+        cache.lpush(BUFFER_KEY, json.dumps(entry))
+        if cache.llen(BUFFER_KEY) >= FLUSH_THRESHOLD:
+            frappe.enqueue(
+                "custom_app.custom_app.error_aggregator.flush_errors",
+                queue="short",
+                job_id="flush_service_errors",
+                deduplicate=True
+            )
+    except Exception:
+        # Without Redis, fall back to logging the failure directly
+        frappe.log_error(frappe.get_traceback(), title)
+
+def get_location(tb):
+    """
+    Returns the innermost frame of this app in the traceback, else the innermost frame.
+    """
+    frames = traceback.extract_tb(tb) if tb else []
+    if not frames:
+        return None
+    app_frames = [frame for frame in frames if APP_PATH in frame.filename]
+    frame = (app_frames or frames)[-1]
+    filename = frame.filename.split(APP_PATH, 1)[-1]
+    return f"{filename}:{frame.lineno} in {frame.name}"
+
+def get_fingerprint(exc_type, location, template):
+    key = "|".join((exc_type.__name__ if exc_type else "", location or "", template or ""))
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+def get_error_log_window():
+    return frappe.conf.get("custom_app_error_log_window") or DEFAULT_ERROR_LOG_WINDOW
+
+def flush_errors():
+    """
+    Drains the buffer into the Service Error aggregates, with one statement per fingerprint,
+    and writes the tracebacks sampled for this window as Error Logs. Returns the failures flushed.
+    """
+    cache = frappe.cache()
+    raw = drain_buffer(cache)
+    if not raw:
+        return 0
+
+    try:
+        save_aggregates(get_aggregates(raw))
+        frappe.db.commit()
+    except Exception:
+        frappe.db.rollback()
+        # Put the failures back for the next flush rather than losing them
+        pipeline = cache.pipeline()
+        pipeline.rpush(cache.make_key(BUFFER_KEY), *raw)
+        pipeline.execute()
+        raise
+
+    return len(raw)
+
+def drain_buffer(cache):
+    """
+    Reads and empties the buffer in one MULTI/EXEC transaction.
+    """
+    pipeline = cache.pipeline(transaction=True)
+    pipeline.lrange(cache.make_key(BUFFER_KEY), 0, -1)
+    pipeline.delete(cache.make_key(BUFFER_KEY))
+    raw, _deleted = pipeline.execute()
+    return raw
+
+def get_aggregates(raw):
+    aggregates = {}
+    for entry in map(json.loads, raw):
+        aggregate = aggregates.get(entry["fingerprint"])
+        if aggregate is None:
+            aggregate = aggregates[entry["fingerprint"]] = frappe._dict(
+                entry, count=0, first_seen=entry["timestamp"], last_seen=entry["timestamp"]
+            )
+        aggregate.count += 1
+        aggregate.first_seen = min(aggregate.first_seen, entry["timestamp"])
+        aggregate.last_seen = max(aggregate.last_seen, entry["timestamp"])
+        aggregate.traceback = aggregate.traceback or entry["traceback"]
+    return aggregates
+
+def save_aggregates(aggregates):
+    """
+    Inserts the Service Error of each fingerprint, or adds to it if it exists.
+    """
+    now, user = frappe.utils.now(), frappe.session.user
+    for fingerprint, aggregate in aggregates.items():
+        error_log = None
+        if aggregate.traceback:
+            error_log = frappe.log_error(aggregate.traceback, aggregate.title).name
+
+        frappe.db.sql(
+            """
+            insert into `tabService Error`
+                (name, creation, modified, owner, modified_by, docstatus, title, exception_type,
+                location, template, `count`, first_seen, last_seen, error_log)
+            values
+                (%(name)s, %(now)s, %(now)s, %(user)s, %(user)s, 0, %(title)s, %(exception_type)s,
+                %(location)s, %(template)s, %(count)s, %(first_seen)s, %(last_seen)s, %(error_log)s)
+            on duplicate key update
+                `count` = `count` + values(`count`),
+                first_seen = least(first_seen, values(first_seen)),
+                last_seen = greatest(last_seen, values(last_seen)),
+                error_log = coalesce(values(error_log), error_log),
+                modified = values(modified)
+            """,
+            {
+                "name": fingerprint,
+                "now": now,
+                "user": user,
+                "title": aggregate.title,
+                "exception_type": aggregate.exception_type,
+                "location": aggregate.location,
+                "template": aggregate.template,
+                "count": aggregate.count,
+                "first_seen": datetime.fromtimestamp(aggregate.first_seen),
+                "last_seen": datetime.fromtimestamp(aggregate.last_seen),
+                "error_log": error_log,
+            },
+        )
+
+@frappe.whitelist()
+def get_top_failures(limit=20, since=None):
+    """
+    Returns the most frequent failures, optionally only those seen since a date.
+    """
+    frappe.only_for("System Manager")
+
+    filters = {"last_seen": [">=", since]} if since else {}
+    return frappe.get_all(
+        "Service Error",
+        filters=filters,
+        fields=["name", "title", "exception_type", "location", "template", "count", "first_seen", "last_seen", "error_log"],
+        order_by="count desc",
+        limit=int(limit)
+    )
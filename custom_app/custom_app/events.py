@@ -0,0 +1,73 @@
+"""
+Entry points for the document events in `hooks.py`.
+
+Each entry point imports the module that does the work on its first call, so a worker only
+loads the code of the events it actually handles: saving an Item or a Code Value does not pull
+in service creation or billing. This module itself must stay free of module-level imports.
+"""
+
+
+def create_services(doc, method=None):
+    from custom_app.custom_app import inpatient_handler
+
+    inpatient_handler.create_services(doc, method)
+
+def invalidate_duplicate_cache(doc, method=None):
+    from custom_app.custom_app import inpatient_handler
+
+    inpatient_handler.invalidate_duplicate_cache(doc, method)
+
+def compact_on_discharge(doc, method=None):
+    from custom_app.custom_app import invoice_compaction
+
+    invoice_compaction.compact_on_discharge(doc, method)
+
+def create_sales_invoice_on_patient_creation(doc, method=None):
+    from custom_app.custom_app import inpatient
+
+    inpatient.create_sales_invoice_on_patient_creation(doc, method)
+
+def clear_billing_invoice(doc, method=None):
+    from custom_app.custom_app import inpatient
+
+    inpatient.clear_billing_invoice(doc, method)
+
+def link_billing_invoice(doc, method=None):
+    from custom_app.custom_app import inpatient
+
+    inpatient.link_billing_invoice(doc, method)
+
+def open_billing_invoice_on_admission(doc, method=None):
+    from custom_app.custom_app import inpatient
+
+    inpatient.open_billing_invoice_on_admission(doc, method)
+
+def create_sales_invoice_for_lab_test(doc, method=None):
+    from custom_app.custom_app import sales_invoice_services
+
+    sales_invoice_services.create_sales_invoice_for_lab_test(doc, method)
+
+def create_sales_invoice_for_medication(doc, method=None):
+    from custom_app.custom_app import sales_invoice_services
+
+    sales_invoice_services.create_sales_invoice_for_medication(doc, method)
+
+def create_sales_invoice_for_procedure(doc, method=None):
+    from custom_app.custom_app import sales_invoice_services
+
+    sales_invoice_services.create_sales_invoice_for_procedure(doc, method)
+
+def create_sales_invoice_for_encounter(doc, method=None):
+    from custom_app.custom_app import sales_invoice_services
+
+    sales_invoice_services.create_sales_invoice_for_encounter(doc, method)
+
+def invalidate_reference_cache(doc, method=None):
+    from custom_app.custom_app import reference_data
+
+    reference_data.invalidate_reference_cache(doc, method)
+
+def invalidate_price_cache(doc, method=None):
+    from custom_app.custom_app import service_item_details
+
+    service_item_details.invalidate_price_cache(doc, method)
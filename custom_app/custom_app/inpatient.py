@@ -1,10 +1,29 @@
 import frappe
 from frappe.utils import nowdate
 
+from custom_app.custom_app.instrumentation import instrumented
 
+
+@instrumented
 def create_sales_invoice_on_patient_creation(doc, method):
+    # Runs on every validate; the customer and billing invoice are only set up once, on creation.
+    # The bulk patient import sets them up itself for whole chunks of patients.
+    if not doc.is_new() or frappe.flags.custom_app_skip_patient_billing:
+        return
+
     customer_name = create_customer_for_patient(doc)
+    doc.customer = customer_name
     
+    si = make_billing_invoice(customer_name)
+    si.insert()
+    doc.custom_billing_invoice = si.name
+    # si.submit()
+
+def make_billing_invoice(customer_name, charges=None):
+    """
+    Returns a new draft Sales Invoice opened with the inpatient service line,
+    followed by any already known `charges` (dicts of item_code, qty, rate, description).
+    """
     si = frappe.new_doc("Sales Invoice")
     si.customer = customer_name
     si.due_date = frappe.utils.nowdate()
@@ -14,24 +33,94 @@ def create_sales_invoice_on_patient_creation(doc, method):
         "qty": 1,
         "rate": 0.00 
     })
-    
-    si.insert()
-    # si.submit()
+    for charge in charges or []:
+        si.append("items", {
+            "item_code": charge.get("item_code"),
+            "qty": charge.get("qty") or 1,
+            "rate": charge.get("rate"),
+            "description": charge.get("description")
+        })
+    return si
+
+def clear_billing_invoice(doc, method=None):
+    """
+    Unlinks a Sales Invoice from its patient once it is submitted, cancelled or deleted,
+    so new charges are never posted to it.
+    """
+    frappe.db.set_value(
+        "Patient", {"custom_billing_invoice": doc.name}, "custom_billing_invoice", None, update_modified=False
+    )
+
+def link_billing_invoice(doc, method=None):
+    """
+    Makes a new draft Sales Invoice of a patient's Customer the patient's billing invoice when
+    they have none, e.g. after the previous one was submitted, and returns the charges parked
+    meanwhile to the outbox.
+    """
+    # The bulk patient import links the invoices of a whole chunk itself
+    if doc.docstatus != 0 or not doc.customer or frappe.flags.custom_app_skip_patient_billing:
+        return
+
+    patient = frappe.db.get_value("Customer", doc.customer, "custom_patient")
+    if not patient or get_billing_invoice(patient):
+        return
+
+    from custom_app.custom_app.charge_accumulator import requeue_unbilled_charges
+
+    frappe.db.set_value("Patient", patient, "custom_billing_invoice", doc.name, update_modified=False)
+    requeue_unbilled_charges(patient)
+
+def open_billing_invoice_on_admission(doc, method=None):
+    """
+    Opens a new draft billing invoice when a patient whose last one was already submitted is
+    admitted again, so the charges of the new stay have an invoice to post to.
+    """
+    if doc.status != "Admitted" or not doc.has_value_changed("status") or get_billing_invoice(doc.patient):
+        return
+
+    patient = frappe.get_doc("Patient", doc.patient)
+    customer_name = create_customer_for_patient(patient)
+    if not patient.customer:
+        frappe.db.set_value("Patient", patient.name, "customer", customer_name, update_modified=False)
+    # Linked to the patient by `link_billing_invoice`
+    make_billing_invoice(customer_name).insert(ignore_permissions=True)
+
+def get_billing_invoice(patient):
+    """
+    Returns the patient's active draft Sales Invoice through a primary-key lookup.
+    """
+    return frappe.db.get_value("Patient", patient, "custom_billing_invoice")
 
 def create_customer_for_patient(patient):
-    customer_name = patient.patient_name
-    existing_customer = frappe.db.get_value("Customer", {"customer_name": customer_name})
+    """
+    Returns the Customer of the patient, matched on the patient ID rather than the name,
+    so different people who share a name never share a Customer.
+    """
+    if patient.customer:
+        return patient.customer
+
+    existing_customer = frappe.db.get_value("Customer", {"custom_patient": patient.name})
     if existing_customer:
         return existing_customer
     else:
-        customer = frappe.new_doc("Customer")
-        customer.customer_name = customer_name
-        customer.customer_group = "Individual" 
-        customer.territory = "All Territories" 
-        customer.customer_type = "Individual"
+        customer = make_customer(patient.name, patient.patient_name)
         customer.save()
         return customer.name
 
+def make_customer(patient_name, customer_name):
+    """
+    Returns a new Customer tagged with the patient ID it bills.
+    """
+    customer = frappe.new_doc("Customer")
+    customer.customer_name = customer_name
+    customer.customer_group = "Individual" 
+    customer.territory = "All Territories" 
+    customer.customer_type = "Individual"
+    customer.custom_patient = patient_name
+    # The patient is only inserted after its validate hook has run
+    customer.flags.ignore_links = True
+    return customer
+
 
 
 # def create_empty_sales_invoice_for_patient(doc, method):
@@ -1,208 +1,333 @@
-import frappe
 import json
+from datetime import datetime
+
+import frappe
 from frappe import _
+from frappe.model import default_fields
+from frappe.utils import cint
+
+from custom_app.custom_app import service_queue
+from custom_app.custom_app.error_aggregator import report_error
+from custom_app.custom_app.instrumentation import instrumented
+from custom_app.custom_app.reference_data import get_code_value
+
+# Child tables of the Inpatient Record that generate services, in processing order:
+# (child table fieldname, service doctype, label used in messages, row field naming the service)
+SERVICE_TABLES = (
+    ("drug_prescription", "Medication Request", "Medication", "drug_name"),
+    ("lab_test_prescription", "Lab Test", "Lab Test", "lab_test_code"),
+    ("procedure_prescription", "Clinical Procedure", "Procedure", "procedure_name"),
+)
+
+# Inpatient Record field holding the JSON list of child rows whose service failed;
+# the next run retries them along with the newly added rows
+RETRY_QUEUE_FIELD = "custom_service_retry_queue"
 
+# Each row's service and Service Request are created under this savepoint,
+# so a failure undoes only that row
+ROW_SAVEPOINT = "custom_app_service_row"
+
+
+@instrumented
 def create_services(doc, method=None):
     """
     Creates services (Medication Request, Lab Test, Clinical Procedure) based on new entries
     in the Inpatient Record's child tables. Only processes entries that have not yet been linked
     to a created service (i.e., where 'custom_linked_document' is not set).
-    This function is triggered after the Inpatient Record is saved, but only if the patient is admitted.
+    This function is triggered when the Inpatient Record is validated, but only if the patient is admitted.
+
+    Only rows added since the previous save are considered, so a save that adds no
+    prescriptions returns without creating anything. All pending rows are collected first so
+    values shared by every service (status, company, order date, service unit) are resolved
+    once per save instead of once per row. Rows that failed in an earlier run are retried.
     """
-    frappe.logger().info(f"Starting service creation for Inpatient Record: {doc.name}")
+    doc_before_save = doc.get_doc_before_save()
+    if doc_before_save:
+        # Only service creation writes the retry queue, and the worker may have done so since the
+        # form loaded: start from the stored queue so a stale form never writes its copy back
+        doc.set(RETRY_QUEUE_FIELD, doc_before_save.get(RETRY_QUEUE_FIELD))
 
     if doc.status != "Admitted":
-        frappe.logger().info(_("No services will be created as the patient is not admitted."))
         return
 
-    errors = []
-    service_created = False  
+    async_enabled = service_queue.is_async_enabled()
+    if async_enabled:
+        service_queue.restore_queued_rows(doc)
 
-    if process_medications(doc, errors):
-        service_created = True
-    if process_lab_tests(doc, errors):
-        service_created = True
-    if process_procedures(doc, errors):
-        service_created = True
+    pending = get_pending_services(doc)
+    if not pending:
+        return
+
+    frappe.logger().info(f"Creating {len(pending)} service(s) for Inpatient Record: {doc.name}")
+
+    if async_enabled:
+        service_queue.queue_services(doc, pending)
+        return
+
+    errors = []
+    created = create_services_for_rows(doc, pending, errors)
 
     if errors:
         error_messages = "\n".join(errors)
         frappe.msgprint(
-            _("Errors occurred while creating services:\n{0}").format(error_messages),
+            _("Errors occurred while creating services:\n{0}\nThe failed rows will be retried on the next save.").format(
+                error_messages
+            ),
             title=_("Service Creation Errors"),
             indicator="red"
         )
-    elif service_created:
+    elif created:
         frappe.msgprint(
             _("Services have been successfully created and corresponding Service Requests have been generated."),
             title=_("Service Creation"),
             indicator="green"
         )
 
-def process_medications(doc, errors):
-    service_created = False  # Track if a service was created
-    if hasattr(doc, 'drug_prescription'):
-        for medication in doc.drug_prescription:
-            if not medication.custom_linked_document:
-                try:
-                    medication_name = medication.drug_name
-                    dosage_form = medication.dosage_form
-                    dosage = medication.dosage
-
-                    # Create a new Medication Request
-                    new_medication = frappe.get_doc({
-                        "doctype": "Medication Request",
-                        "patient": doc.patient,
-                        "inpatient_record": doc.name,
-                        "medication_item": medication_name,
-                        "practitioner": doc.primary_practitioner,
-                        "dosage_form": dosage_form,
-                        "dosage": dosage,
-                    })
-                    new_medication.insert(ignore_permissions=True)
-                    frappe.logger().info(
-                        f"Medication Request '{new_medication.name}' created for medication '{medication_name}'"
-                    )
-
-                    # Update the child table entry and save
-                    medication.custom_linked_document = new_medication.name
-                    medication.db_update()
-
-                    # Create a Service Request for this Medication Request
-                    create_service_request_for_service(
-                        doc=doc,
-                        service_doctype="Medication Request",
-                        service_name=new_medication.name,
-                        service_type=doc.admission_service_unit_type
-                    )
-
-                    service_created = True  # Mark that a service was created
-
-                except Exception as e:
-                    frappe.log_error(frappe.get_traceback(), _("Error creating Medication Request"))
-                    errors.append(f"Medication '{medication_name}': {str(e)}")
-            else:
-                frappe.logger().debug(
-                    f"Medication '{medication.drug_name}' already linked to {medication.custom_linked_document}"
-                )
-    return service_created
-
-def process_lab_tests(doc, errors):
-    service_created = False  # Track if a service was created
-    service_unit = doc.inpatient_occupancies[0].service_unit
-    if hasattr(doc, 'lab_test_prescription'):
-        for lab_test in doc.lab_test_prescription:
-            if not lab_test.custom_linked_document:
-                try:
-                    lab_test_code = lab_test.lab_test_code
-                    patient_sex = doc.gender or "Other"
-                    
-                    # Create a new Lab Test
-                    new_lab_test = frappe.get_doc({
-                        "doctype": "Lab Test",
-                        "patient": doc.patient,
-                        "inpatient_record": doc.name,
-                        "template": lab_test_code,
-                        "patient_sex": patient_sex,
-                        "service_unit": service_unit,
-                        "practitioner": doc.primary_practitioner,
-                        "status": "Draft"
-                    })
-                    new_lab_test.insert(ignore_permissions=True)
-
-                    # Update the child table entry and save
-                    lab_test.custom_linked_document = new_lab_test.name
-                    lab_test.db_update()
-
-                    frappe.logger().info(
-                        f"Lab Test '{new_lab_test.name}' created for template '{lab_test_code}'"
-                    )
-
-                    # Create a Service Request for this Lab Test
-                    create_service_request_for_service(
-                        doc=doc,
-                        service_doctype="Lab Test",
-                        service_name=new_lab_test.name,
-                        service_type=doc.admission_service_unit_type
-                    )
-
-                    service_created = True  # Mark that a service was created
-
-                except Exception as e:
-                    frappe.log_error(frappe.get_traceback(), _("Error creating Lab Test"))
-                    errors.append(f"Lab Test '{lab_test_code}': {str(e)}")
-            else:
-                frappe.logger().debug(
-                    f"Lab Test '{lab_test.lab_test_code}' already linked to {lab_test.custom_linked_document}"
-                )
-    return service_created
-
-def process_procedures(doc, errors):
-    service_created = False  # Track if a service was created
-    if hasattr(doc, 'procedure_prescription'):
-        for procedure in doc.procedure_prescription:
-            if not procedure.custom_linked_document:
-                try:
-                    procedure_name = procedure.procedure_name
-
-                    # Create a new Clinical Procedure
-                    new_procedure = frappe.get_doc({
-                        "doctype": "Clinical Procedure",
-                        "patient": doc.patient,
-                        "inpatient_record": doc.name,
-                        "procedure_template": procedure_name,
-                        "status": "Draft"
-                    })
-                    new_procedure.insert(ignore_permissions=True)
-
-                    # Update the child table entry and save
-                    procedure.custom_linked_document = new_procedure.name
-                    procedure.db_update()
-
-                    frappe.logger().info(
-                        f"Clinical Procedure '{new_procedure.name}' created for procedure '{procedure_name}'"
-                    )
-
-                    # Create a Service Request for this Clinical Procedure
-                    create_service_request_for_service(
-                        doc=doc,
-                        service_doctype="Clinical Procedure",
-                        service_name=new_procedure.name,
-                        service_type=doc.admission_service_unit_type,
-                    )
-
-                    service_created = True  # Mark that a service was created
-
-                except Exception as e:
-                    frappe.log_error(frappe.get_traceback(), _("Error creating Clinical Procedure"))
-                    errors.append(f"Procedure '{procedure_name}': {str(e)}")
-            else:
-                frappe.logger().debug(
-                    f"Procedure '{procedure.procedure_name}' already linked to {procedure.custom_linked_document}"
-                )
-    return service_created
+def get_pending_services(doc):
+    """
+    Returns `(table, row)` pairs for the child rows added since the last save, and the rows
+    in the retry queue, that are not yet linked to a service document.
+    Other rows that already existed were handled by an earlier run, so they are not walked again.
+    On the save that admits the patient every unlinked row is pending, since rows added while
+    the admission was only scheduled were never processed.
+    """
+    doc_before_save = doc.get_doc_before_save()
+    if doc_before_save and doc_before_save.status != "Admitted":
+        doc_before_save = None
+    # The queue is read from the stored record: the worker may have updated it since the form loaded
+    retry_queue = set(get_retry_queue(doc_before_save)) if doc_before_save else set()
+
+    pending = []
+    for table in SERVICE_TABLES:
+        rows = doc.get(table[0]) or []
+        if doc_before_save:
+            rows = get_added_rows(rows, doc_before_save.get(table[0]) or [], retry_queue)
+        for row in rows:
+            if not row.custom_linked_document:
+                pending.append((table, row))
+    return pending
+
+def get_added_rows(rows, rows_before, retry_queue=()):
+    """
+    Returns the rows that were not in the table before this save, plus the queued retries.
+    """
+    if not rows:
+        return []
+    saved_names = {row.name for row in rows_before if row.name not in retry_queue}
+    return [row for row in rows if row.name not in saved_names]
 
-def create_service_request_for_service(doc, service_doctype, service_name, service_type):
-    try:
-        # Determine the current date and time
-        from datetime import datetime
+def get_retry_queue(doc):
+    return json.loads(doc.get(RETRY_QUEUE_FIELD) or "[]")
+
+def set_retry_queue(doc, row_names):
+    doc.set(RETRY_QUEUE_FIELD, json.dumps(sorted(row_names)) if row_names else None)
+
+def create_services_for_rows(doc, pending, errors):
+    """
+    Creates the service document and its submitted Service Request for each pending row.
+    The link is set on the child row in memory; since this runs during `validate`,
+    the parent save writes every linked row back in the same pass.
+
+    Each row runs under its own savepoint: a failure rolls back that row's service and
+    Service Request only, and the row goes into the retry queue instead of aborting the save.
+    Returns the number of services created.
+    """
+    context = ServiceRunContext(doc, pending)
+    created = 0
+    lab_tests = []
+    failed = []
+
+    for table, row in pending:
+        service_ref = row.get(table[3])
+        problem = context.get_row_problem(table, row)
+        if problem:
+            row.custom_service_status = "Failed"
+            failed.append(row.name)
+            errors.append(f"{table[2]} '{service_ref}': {problem}")
+            continue
+
+        frappe.db.savepoint(ROW_SAVEPOINT)
+        try:
+            service_name = create_service_for_row(doc, table, row, context)
+
+        except Exception as e:
+            frappe.db.rollback(save_point=ROW_SAVEPOINT)
+            row.custom_service_status = "Failed"
+            failed.append(row.name)
+            report_error(_("Error creating {0}").format(table[1]), template=row.get(table[3]))
+            errors.append(f"{table[2]} '{service_ref}': {str(e)}")
+            continue
+
+        frappe.db.release_savepoint(ROW_SAVEPOINT)
+        row.custom_linked_document = service_name
+        row.custom_service_status = "Done"
+        created += 1
+        if table[1] == "Lab Test":
+            lab_tests.append((service_name, service_ref))
+
+    set_retry_queue(doc, failed)
+
+    if lab_tests:
+        frappe.db.savepoint(ROW_SAVEPOINT)
+        try:
+            create_specimens_for_lab_tests(doc, lab_tests, context)
+            frappe.db.release_savepoint(ROW_SAVEPOINT)
+        except Exception as e:
+            frappe.db.rollback(save_point=ROW_SAVEPOINT)
+            report_error(_("Error creating Specimen"))
+            errors.append(f"Specimen: {str(e)}")
+
+    return created
+
+def create_service_for_row(doc, table, row, context):
+    """
+    Inserts the service document for one child row together with its Service Request
+    and returns the service name. Raises on failure; the caller rolls back both inserts.
+    """
+    service_doctype = table[1]
+    service = frappe.get_doc(SERVICE_BUILDERS[service_doctype](doc, row, context))
+    service.insert(ignore_permissions=True)
+    frappe.logger().info(f"{service_doctype} '{service.name}' created for '{row.get(table[3])}'")
+
+    create_service_request_for_service(
+        doc=doc,
+        service_doctype=service_doctype,
+        service_name=service.name,
+        service_type=doc.admission_service_unit_type,
+        context=context
+    )
+    return service.name
+
+class ServiceRunContext:
+    """
+    Everything the services of one `create_services` run share, resolved once up front:
+    order date and time, the Draft status, the company, the service unit, and the masters
+    (items and templates) referenced by the pending rows, fetched with one query per doctype.
+    """
+
+    def __init__(self, doc, pending):
         now = datetime.now()
-        order_date = now.date()
-        order_time = now.time().strftime("%H:%M:%S")
+        self.order_date = now.date()
+        self.order_time = now.time().strftime("%H:%M:%S")
+        self.collection_window = now.replace(
+            minute=now.minute - now.minute % SPECIMEN_WINDOW_MINUTES, second=0, microsecond=0
+        )
+        self.status = get_code_value("Draft")
+        self.company = doc.company or frappe.defaults.get_user_default("Company")
+
+        self.service_unit = None
+        if any(table[1] == "Lab Test" for table, row in pending) and doc.get("inpatient_occupancies"):
+            self.service_unit = doc.inpatient_occupancies[0].service_unit
+
+        self.masters = self.prefetch_masters(pending)
+
+    @staticmethod
+    def prefetch_masters(pending):
+        """
+        Returns `{master doctype: {name: row}}` for every item and template the rows reference.
+        """
+        names_by_doctype = {}
+        for table, row in pending:
+            if row.get(table[3]):
+                names_by_doctype.setdefault(SERVICE_MASTERS[table[1]], set()).add(row.get(table[3]))
+
+        masters = {}
+        for master_doctype, names in names_by_doctype.items():
+            fields = SERVICE_MASTER_FIELDS.get(master_doctype, [])
+            masters[master_doctype] = {
+                master.name: master
+                for master in frappe.get_all(
+                    master_doctype, filters={"name": ["in", list(names)]}, fields=["name", *fields]
+                )
+            }
+        return masters
+
+    def get_master(self, table, row):
+        return self.masters.get(SERVICE_MASTERS[table[1]], {}).get(row.get(table[3]))
+
+    def get_row_problem(self, table, row):
+        """
+        Returns why a row cannot be turned into a service, checked in memory before any insert.
+        """
+        if not self.status:
+            return _("Could not find a valid status with code value 'Draft'.")
+        if not self.get_master(table, row):
+            return _("{0} {1} does not exist").format(_(SERVICE_MASTERS[table[1]]), row.get(table[3]))
+
+def get_medication_request(doc, row, context):
+    return {
+        "doctype": "Medication Request",
+        "patient": doc.patient,
+        "inpatient_record": doc.name,
+        "medication_item": row.drug_name,
+        "practitioner": doc.primary_practitioner,
+        "dosage_form": row.dosage_form,
+        "dosage": row.dosage,
+    }
+
+def get_lab_test(doc, row, context):
+    return {
+        "doctype": "Lab Test",
+        "patient": doc.patient,
+        "inpatient_record": doc.name,
+        "template": row.lab_test_code,
+        "patient_sex": doc.gender or "Other",
+        "service_unit": context.service_unit,
+        "practitioner": doc.primary_practitioner,
+        "status": "Draft"
+    }
+
+def get_clinical_procedure(doc, row, context):
+    return {
+        "doctype": "Clinical Procedure",
+        "patient": doc.patient,
+        "inpatient_record": doc.name,
+        "procedure_template": row.procedure_name,
+        "status": "Draft"
+    }
+
+SERVICE_BUILDERS = {
+    "Medication Request": get_medication_request,
+    "Lab Test": get_lab_test,
+    "Clinical Procedure": get_clinical_procedure,
+}
+
+# Master doctype each service is created from; the row field named in SERVICE_TABLES links to it
+SERVICE_MASTERS = {
+    "Medication Request": "Item",
+    "Lab Test": "Lab Test Template",
+    "Clinical Procedure": "Clinical Procedure Template",
+}
+
+# Master columns fetched by the run context besides the name
+SERVICE_MASTER_FIELDS = {
+    "Lab Test Template": ["sample"],
+}
+
+# Lab tests ordered within the same window of this many minutes (at most 60) share one draw
+SPECIMEN_WINDOW_MINUTES = 60
+
+def create_service_request_for_service(doc, service_doctype, service_name, service_type, context=None):
+    """
+    Creates and submits the Service Request for a created service in a single insert.
+    `context` carries the values resolved once per run. Raises on failure, so the caller can
+    roll back the service it was created for instead of leaving it without a request.
+    """
+    try:
+        if context is None:
+            context = ServiceRunContext(doc, [])
 
-        # Get the correct status Code Value document name
-        status_code_value = frappe.get_value("Code Value", {"code_value": "Draft"}, "name")
-        if not status_code_value:
+        if not context.status:
             frappe.throw(_("Could not find a valid status with code value 'Draft'."))
 
-        # Populate the Service Request document with mandatory fields
+        # Inserting with docstatus 1 validates and submits in one write
         service_request = frappe.get_doc({
             "doctype": "Service Request",
             "naming_series": "HSR-",
-            "order_date": order_date,
-            "order_time": order_time,
-            "status": status_code_value,  # Use the correct linked name here
-            "company": doc.company or frappe.defaults.get_user_default("Company"),
+            "order_date": context.order_date,
+            "order_time": context.order_time,
+            "status": context.status,
+            "company": context.company,
             "patient": doc.patient,
             "practitioner": doc.primary_practitioner,
             "template_dt": service_doctype,
@@ -212,76 +337,283 @@ def create_service_request_for_service(doc, service_doctype, service_name, servi
             "referred_to_practitioner": doc.secondary_practitioner,
             "expected_date": doc.expected_discharge,
             "patient_care_type": "Diagnostic",
-            "occurrence_date": order_date
+            "occurrence_date": context.order_date,
+            "docstatus": 1
         })
-
-        # Insert the Service Request
         service_request.insert(ignore_permissions=True)
-        service_request.save()
-        service_request.submit()
         frappe.logger().info(
             f"Service Request '{service_request.name}' created for {service_doctype} '{service_name}'"
         )
 
     except Exception as e:
-        frappe.log_error(frappe.get_traceback(), _("Error creating Service Request"))
+        # The caller logs the failure, with this exception chained to the original one
         frappe.throw(_("An error occurred while creating the Service Request for {0}: {1}").format(service_name, str(e)))
 
-def create_specimen_for_grouped_tests(doc):
+def create_specimens_for_lab_tests(doc, lab_tests, context):
     """
-    This function handles adding grouped lab tests to the specimen after the document is saved.
-    It generates a new specimen if no sample name is provided.
+    Groups the Lab Tests created in one run by the sample of their template and links each group
+    to one Specimen, so a single draw covers every compatible test. A Specimen already created
+    for the patient, sample and collection window by an earlier run is reused.
+    `lab_tests` holds `(lab test name, template)` pairs.
+
+    The cost grows with the number of samples, not of tests: one query finds the existing
+    Specimens, and each sample takes one Specimen insert and one update linking all its tests.
+    Specimens are inserted through the document API, one per sample, so their own validation
+    and naming still run; a run rarely needs more than a handful.
     """
-    sample_name = doc.sample_name if doc.sample_name else "Unknown Sample"
+    templates = context.masters.get("Lab Test Template", {})
+    tests_by_sample = {}
+    for lab_test, template in lab_tests:
+        sample = templates[template].sample if template in templates else None
+        if sample:
+            tests_by_sample.setdefault(sample, []).append(lab_test)
+    if not tests_by_sample:
+        return
 
-    new_specimen = frappe.get_doc({
-        "doctype": "Specimen",
-        "patient": doc.patient,
-        "sample_name": sample_name,
-        "lab_tests": [test.name for test in doc.lab_tests],
-        "status": "Collected"
-    })
+    specimens = dict(frappe.get_all(
+        "Specimen",
+        filters={
+            "patient": doc.patient,
+            "sample_name": ["in", list(tests_by_sample)],
+            "custom_collection_window": context.collection_window
+        },
+        fields=["sample_name", "name"],
+        as_list=True
+    ))
+
+    for sample, names in tests_by_sample.items():
+        if sample not in specimens:
+            new_specimen = frappe.get_doc({
+                "doctype": "Specimen",
+                "patient": doc.patient,
+                "sample_name": sample,
+                "custom_collection_window": context.collection_window,
+                "status": "Collected"
+            })
+            new_specimen.insert(ignore_permissions=True)
+            specimens[sample] = new_specimen.name
+            frappe.logger().info(f"Specimen '{new_specimen.name}' created for sample '{sample}'")
 
-    new_specimen.insert(ignore_permissions=True)
-    frappe.msgprint(f"New Specimen '{new_specimen.name}' created with sample name '{sample_name}'.")
+        frappe.db.set_value(
+            "Lab Test", {"name": ["in", names]}, "custom_specimen", specimens[sample], update_modified=False
+        )
+
+
+# Service types sent by the order-entry form: (service doctype, field holding the ordered template/item)
+DUPLICATE_CHECKS = {
+    "Medication": ("Medication Request", "medication_item"),
+    "Lab Test": ("Lab Test", "template"),
+    "Procedure": ("Clinical Procedure", "procedure_template"),
+}
+
+# Cached duplicate check results per patient expire after this many seconds
+DUPLICATE_CACHE_TTL = 60 * 60
 
 
 @frappe.whitelist()
-def check_duplicate_services(patient, services):
-    duplicates = []
+def check_duplicate_services(patient, services, use_cache=True):
+    """
+    Returns the services the patient already has a non-cancelled, unarchived document for.
+    Services are grouped by type and checked with one `IN` query per doctype; results are
+    cached per patient until one of the service doctypes changes for that patient.
+    """
     # Deserialize 'services' if it's a string
     if isinstance(services, str):
         services = json.loads(services)
-    
+    # Read once: results are written back to the generation they were computed in
+    cache_key = get_duplicate_cache_key(patient) if cint(use_cache) else None
+
+    results = (frappe.cache().get_value(cache_key) if cache_key else None) or {}
+
+    names_by_type = {}
     for service in services:
         service_type = service.get('service_type')
         service_name = service.get('service_name')
+        if service_type in DUPLICATE_CHECKS and (service_type, service_name) not in results:
+            names_by_type.setdefault(service_type, set()).add(service_name)
+
+    for service_type, names in names_by_type.items():
+        doctype, fieldname = DUPLICATE_CHECKS[service_type]
+        existing = set(frappe.get_all(doctype, filters={
+            'patient': patient,
+            fieldname: ['in', list(names)],
+            'docstatus': ['<', 2],
+            'custom_archived': 0
+        }, pluck=fieldname, distinct=True))
+        for service_name in names:
+            results[(service_type, service_name)] = service_name in existing
+
+    if cache_key and names_by_type:
+        frappe.cache().set_value(cache_key, results, expires_in_sec=DUPLICATE_CACHE_TTL)
+
+    return [
+        {
+            'service_type': service.get('service_type'),
+            'service_name': service.get('service_name')
+        }
+        for service in services
+        if results.get((service.get('service_type'), service.get('service_name')))
+    ]
+
+def get_duplicate_cache_key(patient):
+    """
+    Returns the key of the patient's current generation of cached duplicate check results.
+    """
+    generation = cint(frappe.cache().get(get_duplicate_generation_key(patient)))
+    return f"custom_app:duplicate_services:{patient}:{generation}"
+
+def get_duplicate_generation_key(patient):
+    return frappe.cache().make_key(f"custom_app:duplicate_services_generation:{patient}")
+
+def invalidate_duplicate_cache(doc, method=None):
+    """
+    Moves the patient to a new generation of cached duplicate check results when one of their
+    Medication Requests, Lab Tests or Clinical Procedures is inserted, cancelled or deleted.
+    A check that read the database before the change was committed writes its results to the
+    generation it started in, which is no longer read, instead of over the fresh ones.
+    The generation moves again after commit, since checks running until then cannot see the change.
+    """
+    if not doc.get("patient"):
+        return
+
+    generation_key = get_duplicate_generation_key(doc.patient)
+    frappe.cache().incrby(generation_key, 1)
+    frappe.db.after_commit.add(lambda: frappe.cache().incrby(generation_key, 1))
 
-        if service_type == 'Medication':
-            existing = frappe.get_all('Medication Request', filters={
-                'patient': patient,
-                'medication_item': service_name,
-                'docstatus': ['<', 2]
-            }, limit=1)
-        elif service_type == 'Lab Test':
-            existing = frappe.get_all('Lab Test', filters={
-                'patient': patient,
-                'template': service_name,
-                'docstatus': ['<', 2]
-            }, limit=1)
-        elif service_type == 'Procedure':
-            existing = frappe.get_all('Clinical Procedure', filters={
-                'patient': patient,
-                'procedure_template': service_name,
-                'docstatus': ['<', 2]
-            }, limit=1)
+
+# Prescription table of each order type accepted by `create_services_batch`,
+# keyed like the service types of the duplicate check
+ORDER_TABLES = {table[2]: table for table in SERVICE_TABLES}
+
+# Order keys that are not copied to the prescription row
+ORDER_KEYS = ("service_type", "service_name", "allow_duplicate")
+
+# Row fields only service creation writes; an order that set them would skip creating its service
+SERVICE_ROW_FIELDS = ("custom_linked_document", "custom_service_status")
+
+
+@frappe.whitelist()
+def create_services_batch(inpatient_record, orders):
+    """
+    Creates the services for a burst of orders without saving the Inpatient Record.
+
+    `orders` is a list of `{"service_type": "Medication" | "Lab Test" | "Procedure",
+    "service_name": ..., "allow_duplicate": 0}`; any other keys are copied to the prescription row.
+    All orders are validated and checked for duplicates up front, then each one gets its service,
+    Service Request and prescription row under its own savepoint. Rows are inserted directly,
+    already linked, so the parent is never re-saved. Returns one status per order, in order:
+    Created, Duplicate, Invalid or Failed.
+    """
+    if isinstance(orders, str):
+        orders = json.loads(orders)
+
+    frappe.has_permission("Inpatient Record", "write", inpatient_record, throw=True)
+
+    # Serializes batches for the same admission, so row positions never collide
+    frappe.db.get_value("Inpatient Record", inpatient_record, "name", for_update=True)
+    doc = frappe.get_doc("Inpatient Record", inpatient_record)
+    if doc.status != "Admitted":
+        frappe.throw(_("Services can only be ordered for admitted patients."))
+
+    results, pending = prepare_orders(doc, orders)
+    context = ServiceRunContext(doc, [(table, row) for index, table, row in pending])
+
+    next_idx = {table[0]: len(doc.get(table[0]) or []) + 1 for table in SERVICE_TABLES}
+    lab_tests = []
+    for index, table, row in pending:
+        result = results[index]
+        problem = context.get_row_problem(table, row)
+        if problem:
+            result.update(status="Invalid", message=problem)
+            continue
+
+        frappe.db.savepoint(ROW_SAVEPOINT)
+        try:
+            row.custom_linked_document = create_service_for_row(doc, table, row, context)
+            row.custom_service_status = "Done"
+            row.idx = next_idx[table[0]]
+            row.db_insert()
+
+        except Exception as e:
+            frappe.db.rollback(save_point=ROW_SAVEPOINT)
+            report_error(_("Error creating {0}").format(table[1]), template=row.get(table[3]))
+            result.update(status="Failed", message=str(e))
+            continue
+
+        frappe.db.release_savepoint(ROW_SAVEPOINT)
+        next_idx[table[0]] += 1
+        result.update(status="Created", service=row.custom_linked_document, row=row.name)
+        if table[1] == "Lab Test":
+            lab_tests.append((row.custom_linked_document, row.get(table[3])))
+
+    if lab_tests:
+        frappe.db.savepoint(ROW_SAVEPOINT)
+        try:
+            create_specimens_for_lab_tests(doc, lab_tests, context)
+            frappe.db.release_savepoint(ROW_SAVEPOINT)
+        except Exception:
+            frappe.db.rollback(save_point=ROW_SAVEPOINT)
+            report_error(_("Error creating Specimen"))
+
+    if any(result["status"] == "Created" for result in results):
+        # Forms opened before the batch must reload, or their next save would drop the new rows
+        frappe.db.set_value(
+            "Inpatient Record", doc.name,
+            {"modified": frappe.utils.now(), "modified_by": frappe.session.user},
+            update_modified=False
+        )
+
+    return results
+
+def prepare_orders(doc, orders):
+    """
+    Validates the orders in one pass and builds the prescription row of each acceptable one.
+    Duplicates are found with the set-wise duplicate check, plus repeats within the batch.
+    Returns `(results, [(order index, table, row)])`.
+    """
+    results = []
+    for order in orders:
+        results.append({
+            "service_type": order.get("service_type"),
+            "service_name": order.get("service_name"),
+            "status": None,
+        })
+
+    valid = []
+    for index, order in enumerate(orders):
+        if order.get("service_type") not in ORDER_TABLES:
+            results[index].update(status="Invalid", message=_("Unknown service type"))
+        elif not order.get("service_name"):
+            results[index].update(status="Invalid", message=_("Service name is required"))
         else:
-            existing = []
-    
-        if existing:
-            duplicates.append({
-                'service_type': service_type,
-                'service_name': service_name
-            })
-    
-    return duplicates
\ No newline at end of file
+            valid.append(index)
+
+    duplicates = {
+        (service["service_type"], service["service_name"])
+        # Uncached: this transaction may already hold services the cache must not record
+        for service in check_duplicate_services(doc.patient, [orders[index] for index in valid], use_cache=0)
+    }
+
+    pending = []
+    ordered = set()
+    for index in valid:
+        order = orders[index]
+        key = (order["service_type"], order["service_name"])
+        if (key in duplicates or key in ordered) and not cint(order.get("allow_duplicate")):
+            results[index].update(status="Duplicate", message=_("The patient already has this service"))
+            continue
+        ordered.add(key)
+
+        table = ORDER_TABLES[order["service_type"]]
+        row = frappe.new_doc(doc.meta.get_field(table[0]).options, parent_doc=doc, parentfield=table[0])
+        row.update({
+            fieldname: value
+            for fieldname, value in order.items()
+            if row.meta.has_field(fieldname)
+            and fieldname not in default_fields
+            and fieldname not in ORDER_KEYS + SERVICE_ROW_FIELDS
+        })
+        row.set(table[3], order["service_name"])
+        pending.append((index, table, row))
+
+    return results, pending
@@ -0,0 +1,133 @@
+import json
+import math
+import time
+from functools import wraps
+
+import frappe
+
+# Number of invocation records kept in the site-wide ring buffer.
+# Override with `custom_app_instrumentation_buffer` in the site config.
+DEFAULT_BUFFER_SIZE = 1000
+
+BUFFER_KEY = "custom_app:hook_stats"
+
+WRITE_STATEMENTS = ("insert", "update", "delete")
+
+
+def is_enabled():
+    """
+    Instrumentation is on unless `custom_app_instrumentation` is set to 0 in the site config.
+    """
+    return bool(frappe.conf.get("custom_app_instrumentation", 1))
+
+def instrumented(handler):
+    """
+    Wraps a doc_events handler to record its wall time, DB query count, rows written
+    and errors, tagged with the doctype and event it ran for.
+    """
+    @wraps(handler)
+    def wrapper(doc, method=None, *args, **kwargs):
+        if not is_enabled():
+            return handler(doc, method, *args, **kwargs)
+
+        counter = get_query_counter()
+        queries, rows = counter.queries, counter.rows
+        error = None
+        start = time.perf_counter()
+        try:
+            return handler(doc, method, *args, **kwargs)
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            record({
+                "handler": f"{handler.__module__}.{handler.__name__}",
+                "doctype": doc.doctype,
+                "event": method,
+                "docname": doc.name,
+                "duration_ms": round((time.perf_counter() - start) * 1000, 3),
+                "queries": counter.queries - queries,
+                "rows_written": counter.rows - rows,
+                "error": error,
+                "timestamp": time.time(),
+            })
+
+    return wrapper
+
+def get_query_counter():
+    """
+    Returns the query counter of the current database connection, installing it
+    on first use. The counter lives on the connection, so it goes away with it.
+    """
+    db = frappe.db
+    counter = getattr(db, "custom_app_query_counter", None)
+    if counter is None:
+        counter = db.custom_app_query_counter = frappe._dict(queries=0, rows=0)
+        sql = db.sql
+
+        def counted_sql(query, *args, **kwargs):
+            result = sql(query, *args, **kwargs)
+            counter.queries += 1
+            if str(query).lstrip()[:6].lower() in WRITE_STATEMENTS:
+                counter.rows += max(db._cursor.rowcount or 0, 0) if db._cursor else 0
+            return result
+
+        db.sql = counted_sql
+    return counter
+
+def record(entry):
+    buffer_size = frappe.conf.get("custom_app_instrumentation_buffer") or DEFAULT_BUFFER_SIZE
+    try:
+        frappe.cache().lpush(BUFFER_KEY, json.dumps(entry))
+        frappe.cache().ltrim(BUFFER_KEY, 0, buffer_size - 1)
+    except Exception:
+        # Instrumentation must never break the hook it measures
+        pass
+
+    if frappe.conf.get("custom_app_instrumentation_log"):
+        frappe.logger("custom_app.instrumentation").info(entry)
+
+def percentile(values, pct):
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if not values:
+        return None
+    rank = max(math.ceil(pct / 100 * len(values)), 1)
+    return values[rank - 1]
+
+@frappe.whitelist()
+def get_hook_stats():
+    """
+    Summarizes the recorded invocations per handler, doctype and event.
+    """
+    frappe.only_for("System Manager")
+
+    groups = {}
+    for raw in frappe.cache().lrange(BUFFER_KEY, 0, -1):
+        entry = json.loads(raw)
+        groups.setdefault((entry["handler"], entry["doctype"], entry["event"]), []).append(entry)
+
+    stats = []
+    for (handler, doctype, event), entries in groups.items():
+        durations = sorted(entry["duration_ms"] for entry in entries)
+        stats.append({
+            "handler": handler,
+            "doctype": doctype,
+            "event": event,
+            "calls": len(entries),
+            "errors": sum(1 for entry in entries if entry["error"]),
+            "p50_ms": percentile(durations, 50),
+            "p95_ms": percentile(durations, 95),
+            "p99_ms": percentile(durations, 99),
+            "max_ms": durations[-1],
+            "avg_queries": sum(entry["queries"] for entry in entries) / len(entries),
+            "avg_rows_written": sum(entry["rows_written"] for entry in entries) / len(entries),
+        })
+
+    return sorted(stats, key=lambda row: row["p95_ms"], reverse=True)
+
+@frappe.whitelist()
+def clear_hook_stats():
+    frappe.only_for("System Manager")
+    frappe.cache().delete_value(BUFFER_KEY)
@@ -0,0 +1,119 @@
+"""
+Compaction of the draft billing invoices.
+
+Charges are posted one line each, so a long stay bills the same drug at the same rate hundreds
+of times. Compaction merges the lines that bill the same way (same item code, rate, unit and
+description, and same income account, cost center, warehouse, price list rate and discount) into the
+first of them, with the summed quantity. Every Pending Charge keeps pointing at the line that
+now bills it (`sales_invoice_item`), so each merged line still traces back to its services.
+It runs when a patient is discharged, after their last charges are posted, or on demand.
+"""
+
+import frappe
+from frappe import _
+from frappe.utils import flt
+
+from custom_app.custom_app.charge_accumulator import flush_pending_charges, lock_invoice, retry_on_contention
+from custom_app.custom_app.inpatient import get_billing_invoice
+
+# Invoice line fields that must match for two lines to be merged
+MERGE_KEY_FIELDS = (
+    "item_code", "uom", "description", "income_account", "cost_center", "warehouse",
+)
+
+# Amounts that must match too, compared as numbers
+MERGE_KEY_AMOUNTS = ("rate", "price_list_rate", "discount_percentage")
+
+
+def compact_on_discharge(doc, method=None):
+    """
+    Compacts the patient's invoice in the background once the Inpatient Record is discharged.
+    """
+    if doc.status != "Discharged" or not doc.has_value_changed("status"):
+        return
+
+    frappe.enqueue(
+        "custom_app.custom_app.invoice_compaction.compact_patient_invoice",
+        queue="long",
+        job_id=f"compact_patient_invoice::{doc.patient}",
+        deduplicate=True,
+        enqueue_after_commit=True,
+        patient=doc.patient
+    )
+
+def compact_patient_invoice(patient):
+    """
+    Posts the patient's pending charges, then compacts their draft invoice.
+    Returns the number of invoice lines removed.
+    """
+    flush_pending_charges(patient)
+    invoice_name = get_billing_invoice(patient)
+    if not invoice_name:
+        return 0
+    return compact_invoice(invoice_name)
+
+def compact_invoice(invoice_name):
+    """
+    Merges the duplicate lines of a draft invoice and commits. Returns the number of lines removed.
+    """
+    saved = retry_on_contention(merge_invoice_lines, invoice_name)
+    if saved:
+        frappe.logger().info(f"Sales Invoice {invoice_name} compacted: {saved} line(s) merged")
+    return saved
+
+def merge_invoice_lines(invoice_name):
+    """
+    Merges the lines while holding the invoice lock, then points the charges of each removed
+    line at the line that absorbed it.
+    """
+    sales_invoice = lock_invoice(invoice_name)
+    if sales_invoice.docstatus != 0:
+        return 0
+
+    kept = {}
+    merged_into = {}
+    items = []
+    for item in sales_invoice.items:
+        key = get_merge_key(item)
+        target = kept.get(key)
+        if target is None:
+            kept[key] = item
+            items.append(item)
+            continue
+        target.qty = flt(target.qty) + flt(item.qty)
+        merged_into.setdefault(target.name, []).append(item.name)
+
+    if not merged_into:
+        return 0
+
+    for idx, item in enumerate(items, start=1):
+        item.idx = idx
+    sales_invoice.set("items", items)
+    sales_invoice.save(ignore_permissions=True)
+
+    for target, sources in merged_into.items():
+        frappe.db.set_value(
+            "Pending Charge",
+            {"sales_invoice": invoice_name, "sales_invoice_item": ["in", sources]},
+            "sales_invoice_item",
+            target,
+            update_modified=False
+        )
+
+    return sum(len(sources) for sources in merged_into.values())
+
+def get_merge_key(item):
+    return (
+        *(item.get(fieldname) or "" for fieldname in MERGE_KEY_FIELDS),
+        *(flt(item.get(fieldname)) for fieldname in MERGE_KEY_AMOUNTS),
+    )
+
+@frappe.whitelist()
+def compact_billing_invoice(patient):
+    """
+    Compacts the patient's draft invoice on demand, e.g. before printing the bill.
+    """
+    frappe.has_permission("Sales Invoice", "write", throw=True)
+    saved = compact_patient_invoice(patient)
+    frappe.msgprint(_("{0} invoice line(s) merged.").format(saved))
+    return saved
@@ -0,0 +1,246 @@
+"""
+Streaming bulk import of patients and their open charges from the previous HIS.
+
+Records are read from a CSV or JSONL file one chunk at a time, so memory stays bounded
+whatever the file size. Each record holds the Patient fields and an optional `charges`
+list (a JSON string in CSV files) of `item_code`, `qty`, `rate` and `description`.
+
+Every chunk is imported in one transaction: patients are inserted with the per-document
+billing hook switched off, their customers are resolved with one query and the missing ones
+created, and each patient gets its draft Sales Invoice with all open charges in a single
+insert. Finished chunks are recorded in a checkpoint file, so an interrupted import resumes
+where it stopped. The checkpoint also records the chunk size and a fingerprint of the file, and
+is refused for any other file or chunk size, whose chunk indexes would mean other records.
+The `name` a record had in the previous HIS is kept as the patient's `custom_legacy_id`, since
+the Patient naming series assigns a new one. Records whose legacy ID or `uid` matches an existing
+Patient are skipped, so a chunk committed just before the run was interrupted is not imported twice.
+
+    bench --site site1 import-patients patients.jsonl --chunk-size 500 --workers 4
+"""
+
+import csv
+import hashlib
+import json
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import frappe
+from frappe import _
+
+from custom_app.custom_app.inpatient import make_billing_invoice, make_customer
+
+DEFAULT_CHUNK_SIZE = 500
+
+# Patient field holding the ID a record had in the previous HIS
+LEGACY_ID_FIELD = "custom_legacy_id"
+
+# Patient fields an already imported record is recognised by
+IMPORT_KEYS = (LEGACY_ID_FIELD, "uid")
+
+
+def import_patients(path, chunk_size=DEFAULT_CHUNK_SIZE, workers=1, checkpoint_path=None):
+    """
+    Imports every chunk of `path` not yet recorded in the checkpoint, using a pool of
+    `workers` processes. Returns the totals of the chunks imported by this run.
+    """
+    checkpoint_path = checkpoint_path or f"{path}.checkpoint"
+    fingerprint = get_file_fingerprint(path)
+    done = load_checkpoint(checkpoint_path, chunk_size, fingerprint)
+    totals = {"chunks": 0, "patients": 0, "skipped": 0, "customers": 0, "invoices": 0}
+
+    def finish(index, stats):
+        done.add(index)
+        save_checkpoint(checkpoint_path, done, chunk_size, fingerprint)
+        totals["chunks"] += 1
+        for key in ("patients", "skipped", "customers", "invoices"):
+            totals[key] += stats[key]
+        frappe.logger("custom_app.patient_import").info(f"Chunk {index} imported: {stats}")
+
+    chunks = ((index, records) for index, records in read_chunks(path, chunk_size) if index not in done)
+
+    if workers <= 1:
+        for index, records in chunks:
+            finish(index, import_chunk(records))
+        return totals
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=connect_worker,
+        initargs=(frappe.local.site, frappe.local.sites_path),
+    ) as pool:
+        # Only a few chunks are in flight at a time, so the file is never held in memory
+        in_flight = {}
+        for index, records in chunks:
+            in_flight[pool.submit(import_chunk, records)] = index
+            if len(in_flight) >= workers * 2:
+                finished, _pending = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    finish(in_flight.pop(future), future.result())
+
+        for future in wait(in_flight).done:
+            finish(in_flight.pop(future), future.result())
+
+    return totals
+
+def connect_worker(site, sites_path):
+    frappe.init(site=site, sites_path=sites_path)
+    frappe.connect()
+
+def import_chunk(records):
+    """
+    Imports one chunk of patient records in a single transaction and returns its counts.
+    """
+    frappe.flags.custom_app_skip_patient_billing = True
+    try:
+        records = [normalize_record(record) for record in records]
+        existing = get_existing_patients(records)
+        patients = []
+        charges = {}
+        skipped = 0
+        for record in records:
+            if any((key, record.get(key)) in existing for key in IMPORT_KEYS):
+                skipped += 1
+                continue
+
+            patient_charges = record.pop("charges", None) or []
+            if isinstance(patient_charges, str):
+                patient_charges = json.loads(patient_charges)
+
+            patient = frappe.get_doc({"doctype": "Patient", **record})
+            patient.insert(ignore_permissions=True)
+            patients.append(patient)
+            charges[patient.name] = patient_charges
+
+        customers, created = resolve_customers(patients)
+
+        updates = {}
+        for patient in patients:
+            si = make_billing_invoice(customers[patient.name], charges[patient.name])
+            si.insert(ignore_permissions=True)
+            updates[patient.name] = {
+                "customer": customers[patient.name],
+                "custom_billing_invoice": si.name,
+            }
+        if updates:
+            frappe.db.bulk_update("Patient", updates, update_modified=False)
+
+        frappe.db.commit()
+        return {"patients": len(patients), "skipped": skipped, "customers": created, "invoices": len(updates)}
+
+    except Exception:
+        frappe.db.rollback()
+        raise
+
+    finally:
+        frappe.flags.custom_app_skip_patient_billing = False
+
+def normalize_record(record):
+    """
+    Returns a copy of the record with its previous HIS ID moved to the legacy ID field.
+    """
+    record = dict(record)
+    if record.get("name"):
+        record[LEGACY_ID_FIELD] = record.pop("name")
+    return record
+
+def get_existing_patients(records):
+    """
+    Returns `(key, value)` pairs of the chunk's import keys that already exist as Patients,
+    with one query per key.
+    """
+    existing = set()
+    for key in IMPORT_KEYS:
+        values = [record[key] for record in records if record.get(key)]
+        if values:
+            existing.update(
+                (key, value)
+                for value in frappe.get_all("Patient", filters={key: ["in", values]}, pluck=key)
+            )
+    return existing
+
+def resolve_customers(patients):
+    """
+    Returns `({patient: customer}, number created)` for a chunk of patients. Existing
+    customers are found with one query on the indexed patient link; the rest are created.
+    """
+    customers = {patient.name: patient.customer for patient in patients if patient.customer}
+
+    missing = [patient.name for patient in patients if patient.name not in customers]
+    if missing:
+        for row in frappe.get_all(
+            "Customer", filters={"custom_patient": ["in", missing]}, fields=["name", "custom_patient"]
+        ):
+            customers[row.custom_patient] = row.name
+
+    created = 0
+    for patient in patients:
+        if patient.name not in customers:
+            customer = make_customer(patient.name, patient.patient_name)
+            customer.insert(ignore_permissions=True)
+            customers[patient.name] = customer.name
+            created += 1
+
+    return customers, created
+
+def read_chunks(path, chunk_size):
+    """
+    Yields `(index, records)` for consecutive chunks of the file.
+    """
+    chunk = []
+    index = 0
+    for record in read_records(path):
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            yield index, chunk
+            chunk = []
+            index += 1
+    if chunk:
+        yield index, chunk
+
+def read_records(path):
+    with open(path, newline="") as f:
+        if path.endswith(".csv"):
+            for row in csv.DictReader(f):
+                yield {key: value for key, value in row.items() if value not in (None, "")}
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+def get_file_fingerprint(path):
+    """
+    Returns the size and SHA-1 of the file, read in blocks.
+    """
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha1.update(block)
+    return f"{os.path.getsize(path)}:{sha1.hexdigest()}"
+
+def load_checkpoint(path, chunk_size, fingerprint):
+    """
+    Returns the chunk indexes already imported, after checking that the checkpoint was
+    written for the same file and chunk size.
+    """
+    if not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        checkpoint = json.load(f)
+
+    if checkpoint.get("chunk_size") != chunk_size:
+        frappe.throw(
+            _("Checkpoint {0} was written with a chunk size of {1}; resume with that chunk size or remove the checkpoint").format(
+                path, checkpoint.get("chunk_size")
+            )
+        )
+    if checkpoint.get("fingerprint") != fingerprint:
+        frappe.throw(
+            _("Checkpoint {0} was written for another version of the file; remove it to import this file").format(path)
+        )
+    return set(checkpoint["done"])
+
+def save_checkpoint(path, done, chunk_size, fingerprint):
+    # Write then rename, so an interrupted write never corrupts the checkpoint
+    with open(f"{path}.tmp", "w") as f:
+        json.dump({"chunk_size": chunk_size, "fingerprint": fingerprint, "done": sorted(done)}, f)
+    os.replace(f"{path}.tmp", path)
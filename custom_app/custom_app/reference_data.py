@@ -0,0 +1,130 @@
+import json
+import time
+from collections import OrderedDict
+
+import frappe
+
+# Entries in the site-wide (Redis) tier live this long
+SITE_CACHE_TTL = 6 * 60 * 60
+
+# Entries in the in-process tier live this long. Invalidation reaches the other
+# workers' in-process tier only through expiry, so keep this short.
+LOCAL_CACHE_TTL = 60
+
+
+class LocalCache:
+    """
+    In-process LRU cache with a time-to-live per entry.
+    """
+
+    def __init__(self, maxsize=1024, ttl=LOCAL_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        """
+        Returns `(found, value)`; expired entries count as not found.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return False, None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            self.entries.pop(key, None)
+            return False, None
+        self.entries.move_to_end(key)
+        return True, value
+
+    def set(self, key, value):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def delete(self, key):
+        self.entries.pop(key, None)
+
+    def delete_matching(self, predicate):
+        for key in [key for key in self.entries if predicate(key)]:
+            del self.entries[key]
+
+
+local_cache = LocalCache()
+local_stats = {"local_hits": 0, "site_hits": 0, "misses": 0}
+
+
+def get_code_value(code_value, code_system=None):
+    """
+    Returns the name of the Code Value with the given code (and code system).
+    """
+    filters = {"code_value": code_value}
+    if code_system:
+        filters["code_system"] = code_system
+    return get_reference_value("Code Value", filters)
+
+def get_reference_value(doctype, filters, fieldname="name"):
+    """
+    Cached `frappe.db.get_value` for static master data. Looks in the in-process tier,
+    then the site-wide tier, and only then queries the database.
+    Values are dropped from both tiers when a document of `doctype` is updated or deleted.
+    """
+    key = json.dumps([filters, fieldname], sort_keys=True, default=str)
+    local_key = (frappe.local.site, doctype, key)
+
+    found, value = local_cache.get(local_key)
+    if found:
+        local_stats["local_hits"] += 1
+        return value
+
+    site_cache_name = get_site_cache_name(doctype)
+    value = frappe.cache().hget(site_cache_name, key)
+    if value is not None:
+        count("site_hits")
+    else:
+        count("misses")
+        value = frappe.db.get_value(doctype, filters, fieldname)
+        if value is None:
+            # Missing rows are not cached, so they are picked up as soon as they are created
+            return None
+        frappe.cache().hset(site_cache_name, key, value)
+        frappe.cache().expire(frappe.cache().make_key(site_cache_name), SITE_CACHE_TTL)
+
+    local_cache.set(local_key, value)
+    return value
+
+def get_site_cache_name(doctype):
+    return f"custom_app:reference_data:{doctype}"
+
+def count(counter):
+    local_stats[counter] += 1
+    frappe.cache().incrby(get_counter_key(counter), 1)
+
+def get_counter_key(counter):
+    return frappe.cache().make_key(f"custom_app:reference_data:{counter}")
+
+def invalidate_reference_cache(doc, method=None):
+    """
+    Drops the cached values of the document's doctype when one of its documents
+    is updated or deleted.
+    """
+    frappe.cache().delete_value(get_site_cache_name(doc.doctype))
+    site = frappe.local.site
+    local_cache.delete_matching(lambda key: key[0] == site and key[1] == doc.doctype)
+
+@frappe.whitelist()
+def get_reference_cache_stats():
+    """
+    Returns the hit and miss counters of this worker process and of the whole site.
+    Site-wide counters cover site-tier hits and database misses; in-process hits
+    are only counted per process.
+    """
+    frappe.only_for("System Manager")
+
+    return {
+        "process": dict(local_stats),
+        "site": {
+            counter: int(frappe.cache().get(get_counter_key(counter)) or 0)
+            for counter in ("site_hits", "misses")
+        },
+    }
@@ -1,116 +1,156 @@
 import frappe
-from frappe.utils import nowdate
-from .service_item_details import *
 
+from .charge_accumulator import add_charge, add_charges
+from .instrumentation import instrumented
+from .reference_data import get_code_value
+from .service_item_details import (
+    get_item_prices,
+    get_lab_test_item_details,
+    get_medication_item_details,
+    get_procedure_item_details,
+)
+
+
+@instrumented
 def create_sales_invoice_for_lab_test(doc, method):
     
     if not doc.patient:
         frappe.throw("Patient information is required to add to the Sales Invoice.")
 
     service_name, item_code, rate = get_lab_test_item_details(doc)
+    charge_service(doc, service_name, item_code, rate, order=doc.get("service_request"))
 
-    sales_invoices = frappe.get_all("Sales Invoice", filters={"customer": doc.patient, "docstatus": 0})
-    if sales_invoices:
-        sales_invoice = frappe.get_doc("Sales Invoice", sales_invoices[0].name)
-    else:
-        frappe.throw("No draft Sales Invoice found for this patient.")
-
-    sales_invoice.append("items", {
-        "item_code": item_code,
-        "qty": 1,
-        "rate": rate,
-        "description": service_name
-    })
-
-    sales_invoice.save()
-    frappe.msgprint(f"Service {service_name} added to Sales Invoice {sales_invoice.name} (Service ID: {doc.name})")
-
-    submit_or_update_service_request(doc.patient, "Lab Test", doc.name)
+    submit_or_update_service_request(doc.patient, "Lab Test", doc.name, doc.get("service_request"))
 
 
 
+@instrumented
 def create_sales_invoice_for_medication(doc, method):
     if not doc.patient:
         frappe.throw("Patient information is required to add to the Sales Invoice.")
 
     service_name, item_code, rate = get_medication_item_details(doc)
-
-    sales_invoices = frappe.get_all("Sales Invoice", filters={"customer": doc.patient, "docstatus": 0})
-    if sales_invoices:
-        sales_invoice = frappe.get_doc("Sales Invoice", sales_invoices[0].name)
-    else:
-        frappe.throw("No draft Sales Invoice found for this patient.")
-
-    sales_invoice.append("items", {
-        "item_code": item_code,
-        "qty": 1,
-        "rate": rate,
-        "description": service_name
-    })
-
-    sales_invoice.save()
-    frappe.msgprint(f"Service {service_name} added to Sales Invoice {sales_invoice.name} (Service ID: {doc.name})")
+    # A Medication Request is itself the order its encounter line was charged for
+    charge_service(doc, service_name, item_code, rate, order=doc.name)
     submit_or_update_service_request(doc.patient, "Medication Request", doc.name)
 
 
+@instrumented
 def create_sales_invoice_for_procedure(doc, method):
     
     if not doc.patient:
         frappe.throw("Patient information is required to add to the Sales Invoice.")
 
     service_name, item_code, rate = get_procedure_item_details(doc)
+    charge_service(doc, service_name, item_code, rate, order=doc.get("service_request"))
+    submit_or_update_service_request(doc.patient, doc.doctype, doc.name, doc.get("service_request"))
 
-    sales_invoices = frappe.get_all("Sales Invoice", filters={"customer": doc.patient, "docstatus": 0})
-    if sales_invoices:
-        sales_invoice = frappe.get_doc("Sales Invoice", sales_invoices[0].name)
-    else:
-        frappe.throw("No draft Sales Invoice found for this patient.")
+def charge_service(doc, service_name, item_code, rate, order=None):
+    """
+    Records the charge of a submitted service, unless the order it fulfils was already
+    charged as a line of its Patient Encounter.
+    """
+    if order and frappe.db.exists("Pending Charge", {"order_reference": order}):
+        frappe.msgprint(f"Service {service_name} was already charged with its Patient Encounter (Service ID: {doc.name})")
+        return
+
+    add_charge(
+        doc.patient, doc.doctype, doc.name, item_code, rate,
+        description=service_name, inpatient_record=doc.get("inpatient_record")
+    )
+    frappe.msgprint(f"Service {service_name} queued for the patient's Sales Invoice (Service ID: {doc.name})")
 
-    
-    sales_invoice.append("items", {
-        "item_code": item_code,
-        "qty": 1,
-        "rate": rate,
-        "description": service_name
-    })
-
-    sales_invoice.save()
-    frappe.msgprint(f"Service {service_name} added to Sales Invoice {sales_invoice.name} (Service ID: {doc.name})")
-    submit_or_update_service_request(doc.patient, "Medication Request", doc.name)
 
+# Prescription tables of a Patient Encounter:
+# (table fieldname, doctype the line is priced from, row field linking it, row field describing the line)
+ENCOUNTER_TABLES = (
+    ("drug_prescription", "Item", "drug_code", "drug_name"),
+    ("lab_test_prescription", "Lab Test Template", "lab_test_code", "lab_test_name"),
+    ("procedure_prescription", "Clinical Procedure Template", "procedure", "procedure_name"),
+)
 
 
-def submit_or_update_service_request(patient, service_type, service_name):
+@instrumented
+def create_sales_invoice_for_encounter(doc, method):
     """
-    This function will either submit a new service request or update an existing one
-    if it has already been submitted. The service request will be marked as 'Completed'.
+    Bills every prescription of a submitted Patient Encounter. Lines are priced with one query
+    per template doctype and recorded in the outbox with a single insert; they are posted to the
+    patient's Sales Invoice with one save right after commit. Each charge records the Service
+    Request or Medication Request its line ordered, so the service that later fulfils the order
+    is not charged a second time. The Service Requests are completed when their service is submitted.
     """
+    if not doc.patient:
+        frappe.throw("Patient information is required to add to the Sales Invoice.")
 
-    status_code_value = frappe.get_value("Code Value", 
-        {
-            "code_value": "completed",  
-            "code_system": "Request Status"  
-        }, 
-        "name"
-    )
+    rows_by_doctype = {}
+    for fieldname, price_doctype, link_field, description_field in ENCOUNTER_TABLES:
+        for row in doc.get(fieldname) or []:
+            if row.get(link_field):
+                rows_by_doctype.setdefault(price_doctype, []).append((row, link_field, description_field))
+
+    charges = []
+    unpriced = []
+    for price_doctype, rows in rows_by_doctype.items():
+        prices = get_item_prices(price_doctype, [row.get(link_field) for row, link_field, description_field in rows])
+        for row, link_field, description_field in rows:
+            item_code, rate = prices[row.get(link_field)]
+            if not item_code:
+                unpriced.append(row.get(link_field))
+                continue
+            charges.append({
+                "service_doctype": row.doctype,
+                "service_name": row.name,
+                "item_code": item_code,
+                "rate": rate,
+                "description": row.get(description_field) or row.get(link_field),
+                "order_reference": row.get("service_request") or row.get("medication_request"),
+            })
+
+    queued = add_charges(doc.patient, charges, inpatient_record=doc.get("inpatient_record"), flush=True)
+    if queued:
+        frappe.msgprint(f"{queued} service(s) of encounter {doc.name} queued for the patient's Sales Invoice")
+    if unpriced:
+        frappe.msgprint(f"No item found to bill {', '.join(unpriced)}; these lines were not charged.")
+
+def submit_or_update_service_request(patient, service_type, service_name, service_request=None):
+    """
+    Marks the submitted service requests of a service as 'Completed', including the
+    `service_request` it was ordered by, if any.
+    Candidates come from one indexed query that already leaves out completed and cancelled
+    requests, so the cost does not depend on how many Service Requests the patient has.
+    Each match (usually exactly one) is saved through the document API, so its
+    `on_update_after_submit`, version history and workflow still run.
+    """
+
+    status_code_value = get_code_value("completed", "Request Status")
 
-    existing_service_request = frappe.get_all("Service Request", filters={
+    service_requests = frappe.get_all("Service Request", filters={
         "patient": patient,
         "template_dt": service_type,
-        "template_dn": service_name
-    })
-
-    if existing_service_request:
-        
-        for request in existing_service_request:
-            service_request_doc = frappe.get_doc("Service Request", request.name)
-            if service_request_doc.docstatus == 1:  
-                if service_request_doc.status != "Completed":
-                    service_request_doc.status = status_code_value
-                    service_request_doc.save(ignore_permissions=True)
-                    frappe.msgprint(f"Existing service request {service_request_doc.name} has been updated to Completed.")
-            else:
-                frappe.throw(f"Service request {service_request_doc.name} is not submitted yet.")
+        "template_dn": service_name,
+        "status": ["!=", status_code_value],
+        "docstatus": ["<", 2],
+        "custom_archived": 0
+    }, fields=["name", "docstatus"])
+    if service_request and service_request not in {request.name for request in service_requests}:
+        service_requests += frappe.get_all("Service Request", filters={
+            "name": service_request,
+            "status": ["!=", status_code_value],
+            "docstatus": ["<", 2]
+        }, fields=["name", "docstatus"])
+
+    if service_requests:
+        not_submitted = [request.name for request in service_requests if request.docstatus != 1]
+        if not_submitted:
+            frappe.throw(f"Service request {not_submitted[0]} is not submitted yet.")
+
+        names = [request.name for request in service_requests]
+        for name in names:
+            # `status` is an allow-on-submit field, so the submitted request is saved in place
+            request = frappe.get_doc("Service Request", name)
+            request.status = status_code_value
+            request.save(ignore_permissions=True)
+        frappe.msgprint(f"Existing service request {', '.join(names)} has been updated to Completed.")
     # else:
     #     # Create a new service request if it doesn't exist
     #     new_service_request = frappe.get_doc({
@@ -1,12 +1,89 @@
 import frappe
 
+from custom_app.custom_app.reference_data import SITE_CACHE_TTL, LocalCache
+
+# The single rate column read for each priced doctype
+RATE_FIELDS = {
+    "Lab Test Template": "lab_test_rate",
+    "Clinical Procedure Template": "rate",
+    "Item": "valuation_rate",
+}
+
+# Item each template is billed under; an Item is billed under itself
+ITEM_FIELDS = {
+    "Lab Test Template": "item",
+    "Clinical Procedure Template": "item",
+}
+
+# In-process tier of resolved `(item code, rate)` pairs, keyed by (site, doctype, name), in front of
+# the site-wide tier, a Redis hash per doctype. An update clears both tiers for the whole site, but
+# only its own process's in-process entry: other processes keep billing the old rate until their
+# entry expires, i.e. for up to LOCAL_CACHE_TTL (60 s), as with the reference data.
+price_cache = LocalCache(maxsize=4096)
+
+
 def get_lab_test_item_details(doc):
-    lab_test_template = frappe.get_doc("Lab Test Template", doc.template)
-    return doc.lab_test_name, doc.lab_test_name, lab_test_template.lab_test_rate
+    return doc.lab_test_name, doc.lab_test_name, get_rate("Lab Test Template", doc.template)
 
 def get_medication_item_details(doc):
-    item = frappe.get_doc("Item", doc.medication_item)
-    return doc.medication, doc.medication_item, item.valuation_rate
+    return doc.medication, doc.medication_item, get_rate("Item", doc.medication_item)
 
 def get_procedure_item_details(doc):
-    return doc.procedure_name, doc.item_code, doc.rate
\ No newline at end of file
+    return doc.procedure_name, doc.item_code, doc.rate
+
+def get_rate(doctype, name):
+    """
+    Returns the rate of a Lab Test Template or Item.
+    """
+    return get_item_prices(doctype, [name])[name][1]
+
+def get_item_prices(doctype, names):
+    """
+    Returns `{name: (item code, rate)}` for many templates or items. Looks in the in-process
+    tier, then the site-wide tier, and queries the ones found in neither in a single statement,
+    reading only their item and rate columns.
+    """
+    site = frappe.local.site
+    site_cache_name = get_price_cache_name(doctype)
+    prices = {}
+    missing = []
+    for name in set(names):
+        found, price = price_cache.get((site, doctype, name))
+        if not found:
+            price = frappe.cache().hget(site_cache_name, name)
+            if price is not None:
+                price_cache.set((site, doctype, name), price)
+        if price is not None:
+            prices[name] = price
+        else:
+            missing.append(name)
+
+    if missing:
+        rate_field = RATE_FIELDS[doctype]
+        item_field = ITEM_FIELDS.get(doctype, "name")
+        fetched = {
+            row.name: (row.get(item_field), row.get(rate_field))
+            for row in frappe.get_all(
+                doctype, filters={"name": ["in", missing]}, fields=list({"name", item_field, rate_field})
+            )
+        }
+        for name in missing:
+            prices[name] = fetched.get(name, (None, None))
+            # Missing rows are not cached, so they are priced as soon as they are created
+            if name in fetched:
+                frappe.cache().hset(site_cache_name, name, prices[name])
+                price_cache.set((site, doctype, name), prices[name])
+        if fetched:
+            frappe.cache().expire(frappe.cache().make_key(site_cache_name), SITE_CACHE_TTL)
+
+    return prices
+
+def get_price_cache_name(doctype):
+    return f"custom_app:item_prices:{doctype}"
+
+def invalidate_price_cache(doc, method=None):
+    """
+    Drops the cached price of the template or item from both tiers when it is updated or deleted.
+    """
+    frappe.cache().hdel(get_price_cache_name(doc.doctype), doc.name)
+    price_cache.delete((frappe.local.site, doc.doctype, doc.name))
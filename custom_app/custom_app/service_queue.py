@@ -0,0 +1,210 @@
+import json
+
+import frappe
+from frappe import _
+
+from custom_app.custom_app.error_aggregator import report_error
+
+# Values of the `custom_service_status` field on the prescription child rows
+PENDING = "Pending"
+PROCESSING = "Processing"
+DONE = "Done"
+FAILED = "Failed"
+
+WORKER_METHOD = "custom_app.custom_app.service_queue.process_pending_services"
+
+
+def is_async_enabled():
+    """
+    Service creation runs in a background job when `custom_app_async_services`
+    is set in the site config; otherwise it runs inside the Inpatient Record save.
+    """
+    return bool(frappe.conf.get("custom_app_async_services"))
+
+def queue_services(doc, pending):
+    """
+    Records the pending rows on the Inpatient Record and enqueues the worker.
+    Called from `validate`, so the statuses are written by the parent save and
+    the save costs the same whatever the number of prescriptions.
+    Queued retries are handed to the worker, which puts them back in the queue if they fail again.
+    """
+    from custom_app.custom_app.inpatient_handler import set_retry_queue
+
+    set_retry_queue(doc, [])
+    queued = 0
+    for _table, row in pending:
+        if row.custom_linked_document:
+            continue
+        if row.custom_service_status != PROCESSING:
+            row.custom_service_status = PENDING
+        queued += 1
+
+    if queued:
+        enqueue_worker(doc.name)
+        frappe.msgprint(
+            _("{0} service(s) queued for creation.").format(queued),
+            title=_("Service Creation"),
+            indicator="blue"
+        )
+
+def restore_queued_rows(doc):
+    """
+    Rows queued by an earlier save may have been linked by the worker since the form was loaded.
+    Reload their link and status so this save does not write the stale values back.
+    """
+    from custom_app.custom_app.inpatient_handler import SERVICE_TABLES
+
+    queued = {}
+    for table in SERVICE_TABLES:
+        for row in doc.get(table[0]) or []:
+            if row.custom_service_status in (PENDING, PROCESSING) and not row.is_new():
+                queued.setdefault(row.doctype, {})[row.name] = row
+
+    for child_doctype, rows in queued.items():
+        for current in frappe.get_all(
+            child_doctype,
+            filters={"name": ["in", list(rows)]},
+            fields=["name", "custom_linked_document", "custom_service_status"]
+        ):
+            row = rows[current.name]
+            row.custom_linked_document = current.custom_linked_document
+            row.custom_service_status = current.custom_service_status
+
+def enqueue_worker(inpatient_record):
+    """
+    Runs the worker once the save is committed. Jobs are deduplicated per Inpatient Record;
+    with `custom_app_run_jobs_inline` (or in tests) the worker runs in-process after commit,
+    so no Redis queue is needed.
+    """
+    if frappe.flags.in_test or frappe.conf.get("custom_app_run_jobs_inline"):
+        frappe.db.after_commit.add(lambda: process_pending_services(inpatient_record))
+        return
+
+    frappe.enqueue(
+        WORKER_METHOD,
+        queue="short",
+        job_id=f"create_services::{inpatient_record}",
+        deduplicate=True,
+        enqueue_after_commit=True,
+        inpatient_record=inpatient_record
+    )
+
+def process_pending_services(inpatient_record):
+    """
+    Creates the services for every queued row of an Inpatient Record.
+    Each row is locked and re-checked before work starts and committed on its own,
+    so retries and duplicate jobs never create a second service for the same row.
+    Failed rows are rolled back and added to the Inpatient Record's retry queue.
+    """
+    from custom_app.custom_app.inpatient_handler import (
+        SERVICE_TABLES,
+        ServiceRunContext,
+        create_service_for_row,
+        create_specimens_for_lab_tests,
+    )
+
+    doc = frappe.get_doc("Inpatient Record", inpatient_record)
+    queued = [
+        (table, row)
+        for table in SERVICE_TABLES
+        for row in doc.get(table[0]) or []
+        if not row.custom_linked_document and row.custom_service_status in (PENDING, PROCESSING)
+    ]
+    if not queued:
+        return
+
+    set_row_status(queued, PROCESSING)
+    frappe.db.commit()
+
+    context = ServiceRunContext(doc, queued)
+    lab_tests = []
+    failed = []
+    for table, row in queued:
+        current = frappe.db.get_value(
+            row.doctype, row.name, ["custom_linked_document", "custom_service_status"],
+            as_dict=True, for_update=True
+        )
+        if not current or current.custom_linked_document or current.custom_service_status != PROCESSING:
+            frappe.db.rollback()
+            continue
+
+        try:
+            problem = context.get_row_problem(table, row)
+            if problem:
+                frappe.throw(problem)
+            service_name = create_service_for_row(doc, table, row, context)
+            frappe.db.set_value(
+                row.doctype, row.name,
+                {"custom_linked_document": service_name, "custom_service_status": DONE},
+                update_modified=False
+            )
+            frappe.db.commit()
+            if table[1] == "Lab Test":
+                lab_tests.append((service_name, row.get(table[3])))
+
+        except Exception:
+            frappe.db.rollback()
+            report_error(_("Error creating {0}").format(table[1]), template=row.get(table[3]))
+            frappe.db.set_value(row.doctype, row.name, "custom_service_status", FAILED, update_modified=False)
+            frappe.db.commit()
+            failed.append(row.name)
+
+    if failed:
+        add_to_retry_queue(inpatient_record, failed)
+
+    if lab_tests:
+        try:
+            create_specimens_for_lab_tests(doc, lab_tests, context)
+            frappe.db.commit()
+        except Exception:
+            frappe.db.rollback()
+            report_error(_("Error creating Specimen"))
+
+def add_to_retry_queue(inpatient_record, row_names):
+    """
+    Adds failed rows to the stored retry queue of an Inpatient Record, under a row lock
+    so a concurrent save or job does not lose entries.
+    """
+    from custom_app.custom_app.inpatient_handler import RETRY_QUEUE_FIELD
+
+    queue = frappe.db.get_value("Inpatient Record", inpatient_record, RETRY_QUEUE_FIELD, for_update=True)
+    queue = set(json.loads(queue or "[]")) | set(row_names)
+    frappe.db.set_value(
+        "Inpatient Record", inpatient_record, RETRY_QUEUE_FIELD, json.dumps(sorted(queue)), update_modified=False
+    )
+    frappe.db.commit()
+
+def set_row_status(rows, status):
+    """
+    Updates the status of many child rows with one statement per child doctype.
+    """
+    names_by_doctype = {}
+    for _table, row in rows:
+        names_by_doctype.setdefault(row.doctype, []).append(row.name)
+
+    for child_doctype, names in names_by_doctype.items():
+        frappe.db.set_value(
+            child_doctype, {"name": ["in", names]}, "custom_service_status", status, update_modified=False
+        )
+
+@frappe.whitelist()
+def get_service_status(inpatient_record):
+    """
+    Returns the creation status of every prescription row of an Inpatient Record.
+    """
+    from custom_app.custom_app.inpatient_handler import SERVICE_TABLES
+
+    frappe.has_permission("Inpatient Record", "read", inpatient_record, throw=True)
+
+    doc = frappe.get_doc("Inpatient Record", inpatient_record)
+    rows = []
+    for fieldname, _service_doctype, label, name_field in SERVICE_TABLES:
+        for row in doc.get(fieldname) or []:
+            rows.append({
+                "row": row.name,
+                "service_type": label,
+                "service_name": row.get(name_field),
+                "status": row.custom_service_status or (DONE if row.custom_linked_document else ""),
+                "linked_document": row.custom_linked_document,
+            })
+    return rows
@@ -14,22 +14,57 @@ app_license = "mit"
 
 doc_events = {
     "Inpatient Record": {
-        "validate": "custom_app.custom_app.inpatient_handler.create_services"
+        "validate": "custom_app.custom_app.events.create_services",
+        "on_update": [
+            "custom_app.custom_app.events.open_billing_invoice_on_admission",
+            "custom_app.custom_app.events.compact_on_discharge"
+        ]
     },
     "Patient": {
-        "validate": "custom_app.custom_app.inpatient.create_sales_invoice_on_patient_creation"
+        "validate": "custom_app.custom_app.events.create_sales_invoice_on_patient_creation"
     },
     "Lab Test": {
-        "on_submit": "custom_app.custom_app.sales_invoice_services.create_sales_invoice_for_lab_test"
+        "after_insert": "custom_app.custom_app.events.invalidate_duplicate_cache",
+        "on_submit": "custom_app.custom_app.events.create_sales_invoice_for_lab_test",
+        "on_cancel": "custom_app.custom_app.events.invalidate_duplicate_cache",
+        "on_trash": "custom_app.custom_app.events.invalidate_duplicate_cache"
         },
     "Medication Request": {
-        "on_submit": "custom_app.custom_app.sales_invoice_services.create_sales_invoice_for_medication"
+        "after_insert": "custom_app.custom_app.events.invalidate_duplicate_cache",
+        "on_submit": "custom_app.custom_app.events.create_sales_invoice_for_medication",
+        "on_cancel": "custom_app.custom_app.events.invalidate_duplicate_cache",
+        "on_trash": "custom_app.custom_app.events.invalidate_duplicate_cache"
         },
     "Clinical Procedure": {
-        "on_submit": "custom_app.custom_app.sales_invoice_services.create_sales_invoice_for_procedure"
+        "after_insert": "custom_app.custom_app.events.invalidate_duplicate_cache",
+        "on_submit": "custom_app.custom_app.events.create_sales_invoice_for_procedure",
+        "on_cancel": "custom_app.custom_app.events.invalidate_duplicate_cache",
+        "on_trash": "custom_app.custom_app.events.invalidate_duplicate_cache"
         },
     "Patient Encounter": {
-        "on_submit": "custom_app.custom_app.sales_invoice_services.create_sales_invoice_for_procedure"
+        "on_submit": "custom_app.custom_app.events.create_sales_invoice_for_encounter"
+        },
+    "Code Value": {
+        "on_update": "custom_app.custom_app.events.invalidate_reference_cache",
+        "on_trash": "custom_app.custom_app.events.invalidate_reference_cache"
+        },
+    "Lab Test Template": {
+        "on_update": "custom_app.custom_app.events.invalidate_price_cache",
+        "on_trash": "custom_app.custom_app.events.invalidate_price_cache"
+        },
+    "Clinical Procedure Template": {
+        "on_update": "custom_app.custom_app.events.invalidate_price_cache",
+        "on_trash": "custom_app.custom_app.events.invalidate_price_cache"
+        },
+    "Item": {
+        "on_update": "custom_app.custom_app.events.invalidate_price_cache",
+        "on_trash": "custom_app.custom_app.events.invalidate_price_cache"
+        },
+    "Sales Invoice": {
+        "after_insert": "custom_app.custom_app.events.link_billing_invoice",
+        "on_submit": "custom_app.custom_app.events.clear_billing_invoice",
+        "on_cancel": "custom_app.custom_app.events.clear_billing_invoice",
+        "on_trash": "custom_app.custom_app.events.clear_billing_invoice"
         },
 }
 
@@ -106,7 +141,8 @@ doc_events = {
 # ------------
 
 # before_install = "custom_app.install.before_install"
-# after_install = "custom_app.install.after_install"
+after_install = "custom_app.install.after_install"
+after_migrate = "custom_app.install.after_migrate"
 
 # Uninstallation
 # ------------
@@ -171,6 +207,16 @@ doc_events = {
 # Scheduled Tasks
 # ---------------
 
+scheduler_events = {
+    "all": [
+        "custom_app.custom_app.charge_accumulator.flush_pending_charges",
+        "custom_app.custom_app.error_aggregator.flush_errors"
+    ],
+    "hourly": [
+        "custom_app.custom_app.archive.archive_discharged_admissions"
+    ],
+}
+
 # scheduler_events = {
 # 	"all": [
 # 		"custom_app.tasks.all"
@@ -0,0 +1,147 @@
+import frappe
+from frappe.custom.doctype.custom_field.custom_field import create_custom_fields
+
+PRESCRIPTION_DOCTYPES = ("Drug Prescription", "Lab Prescription", "Procedure Prescription")
+
+# Doctypes whose documents are moved out of the hot set once their admission is archived
+ARCHIVED_DOCTYPES = ("Service Request", "Medication Request", "Lab Test", "Clinical Procedure")
+
+# Composite indexes on doctypes of other apps, for the lookups this app runs on every save.
+# The lookups by patient lead with it and the archived flag, which keeps archived history out of the scan.
+INDEXES = (
+    ("Patient", ["customer"]),
+    ("Sales Invoice", ["customer", "docstatus"]),
+    ("Service Request", ["patient", "custom_archived", "template_dt", "template_dn"]),
+    ("Medication Request", ["patient", "custom_archived", "medication_item"]),
+    ("Lab Test", ["patient", "custom_archived", "template"]),
+    ("Clinical Procedure", ["patient", "custom_archived", "procedure_template"]),
+    ("Inpatient Record", ["status", "custom_archived"]),
+)
+
+
+def after_install():
+    make_custom_fields()
+    make_indexes()
+
+def after_migrate():
+    make_custom_fields()
+    make_indexes()
+
+def make_custom_fields():
+    """
+    Creates or updates the custom fields this app relies on. Runs after install and
+    after every migrate, so new fields only need to be added here.
+    """
+    create_custom_fields(get_custom_fields(), update=True)
+
+def make_indexes():
+    """
+    Adds the composite indexes that are missing. Runs after install and after every migrate,
+    so a site restored from a backup or a rebuilt table gets them back.
+    """
+    for doctype, columns in INDEXES:
+        frappe.db.add_index(doctype, columns)
+
+def get_custom_fields():
+    return {
+        "Customer": [
+            {
+                "fieldname": "custom_patient",
+                "label": "Patient",
+                "fieldtype": "Link",
+                "options": "Patient",
+                "insert_after": "customer_name",
+                "read_only": 1,
+                "no_copy": 1,
+                "search_index": 1,
+            },
+        ],
+        "Patient": [
+            {
+                "fieldname": "custom_billing_invoice",
+                "label": "Billing Invoice",
+                "fieldtype": "Link",
+                "options": "Sales Invoice",
+                "insert_after": "customer",
+                "read_only": 1,
+                "no_copy": 1,
+                "search_index": 1,
+            },
+            {
+                "fieldname": "custom_legacy_id",
+                "label": "Legacy ID",
+                "fieldtype": "Data",
+                "insert_after": "custom_billing_invoice",
+                "read_only": 1,
+                "no_copy": 1,
+                "unique": 1,
+            },
+        ],
+        "Inpatient Record": [
+            {
+                "fieldname": "custom_service_retry_queue",
+                "label": "Service Retry Queue",
+                "fieldtype": "Small Text",
+                "insert_after": "procedure_prescription",
+                "read_only": 1,
+                "hidden": 1,
+                "no_copy": 1,
+            },
+            {
+                "fieldname": "custom_archived",
+                "label": "Archived",
+                "fieldtype": "Check",
+                "default": "0",
+                "insert_after": "status",
+                "read_only": 1,
+                "no_copy": 1,
+                "search_index": 1,
+            },
+        ],
+        "Lab Test": [
+            {
+                "fieldname": "custom_specimen",
+                "label": "Specimen",
+                "fieldtype": "Link",
+                "options": "Specimen",
+                "insert_after": "template",
+                "read_only": 1,
+                "no_copy": 1,
+                "search_index": 1,
+            },
+        ],
+        "Specimen": [
+            {
+                "fieldname": "custom_collection_window",
+                "label": "Collection Window",
+                "fieldtype": "Datetime",
+                "insert_after": "sample_name",
+                "read_only": 1,
+                "no_copy": 1,
+                "search_index": 1,
+            },
+        ],
+        ARCHIVED_DOCTYPES: [
+            {
+                "fieldname": "custom_archived",
+                "label": "Archived",
+                "fieldtype": "Check",
+                "default": "0",
+                "insert_after": "patient",
+                "read_only": 1,
+                "no_copy": 1,
+            },
+        ],
+        PRESCRIPTION_DOCTYPES: [
+            {
+                "fieldname": "custom_service_status",
+                "label": "Service Status",
+                "fieldtype": "Select",
+                "options": "\nPending\nProcessing\nDone\nFailed",
+                "insert_after": "custom_linked_document",
+                "read_only": 1,
+                "no_copy": 1,
+                "in_list_view": 1,
+            },
+        ],
+    }
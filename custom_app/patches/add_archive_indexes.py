@@ -0,0 +1,9 @@
+from custom_app.install import make_custom_fields, make_indexes
+
+
+def execute():
+    """
+    Adds the archived flag and the indexes that keep the hot-path lookups on unarchived documents.
+    """
+    make_custom_fields()
+    make_indexes()
@@ -0,0 +1,8 @@
+from custom_app.custom_app.doctype.pending_charge.pending_charge import on_doctype_update
+
+
+def execute():
+    """
+    Enforces that a service is charged only once and supports the outbox drain order.
+    """
+    on_doctype_update()
@@ -0,0 +1,49 @@
+import frappe
+
+from custom_app.install import make_custom_fields
+
+
+def execute():
+    """
+    Links every patient to its Customer and back.
+
+    Customers created before the Customer was tied to the patient ID were never set on the
+    patient; they are found through the keys the old lookups used: a Customer named after the
+    patient ID, or one whose `customer_name` is the patient name, as long as no other patient
+    shares that name.
+    """
+    make_custom_fields()
+
+    frappe.db.add_index("Patient", ["customer"])
+
+    patients = frappe.get_all(
+        "Patient", fields=["name", "patient_name", "customer"], order_by="creation asc"
+    )
+    customers = frappe.get_all("Customer", fields=["name", "customer_name", "custom_patient"])
+    linked = {customer.name for customer in customers if customer.custom_patient}
+    by_name = {}
+    for customer in customers:
+        if not customer.custom_patient:
+            by_name.setdefault(customer.customer_name, []).append(customer.name)
+    existing = {customer.name for customer in customers}
+
+    name_counts = {}
+    for patient in patients:
+        name_counts[patient.patient_name] = name_counts.get(patient.patient_name, 0) + 1
+
+    for patient in patients:
+        customer = patient.customer
+        if not customer:
+            if patient.name in existing:
+                customer = patient.name
+            elif name_counts[patient.patient_name] == 1 and len(by_name.get(patient.patient_name, [])) == 1:
+                customer = by_name[patient.patient_name][0]
+            if not customer or customer in linked:
+                continue
+            frappe.db.set_value("Patient", patient.name, "customer", customer, update_modified=False)
+
+        # A customer shared by several same-name patients stays with the first one
+        if customer in linked:
+            continue
+        frappe.db.set_value("Customer", customer, "custom_patient", patient.name, update_modified=False)
+        linked.add(customer)
@@ -0,0 +1,23 @@
+import frappe
+
+from custom_app.custom_app.billing_summary import CATEGORY_FIELDS, rebuild_summaries
+
+
+def execute():
+    """
+    Links the existing charges to the admission of their service and builds the billing summaries.
+    """
+    for service_doctype in CATEGORY_FIELDS:
+        if not frappe.db.has_column(service_doctype, "inpatient_record"):
+            continue
+        frappe.db.sql(
+            f"""
+            update `tabPending Charge` charge
+            join `tab{service_doctype}` service on service.name = charge.service_name
+            set charge.inpatient_record = service.inpatient_record
+            where charge.service_doctype = %s and charge.inpatient_record is null
+            """,
+            service_doctype,
+        )
+
+    rebuild_summaries()
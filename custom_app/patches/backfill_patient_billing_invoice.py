@@ -0,0 +1,52 @@
+from collections import Counter
+
+import frappe
+
+from custom_app.install import make_custom_fields
+
+
+def execute():
+    """
+    Links every patient to its newest draft Sales Invoice and indexes the columns
+    the billing lookups filter on.
+
+    Invoices created before the Customer was tied to the patient ID are found through the keys
+    the old lookups used: a Customer named after the patient ID, or one whose `customer_name`
+    is the patient name, as long as no other patient shares that name.
+    """
+    make_custom_fields()
+
+    frappe.db.add_index("Sales Invoice", ["customer", "docstatus"])
+
+    patients = frappe.get_all(
+        "Patient",
+        filters={"custom_billing_invoice": ["is", "not set"]},
+        fields=["name", "patient_name", "customer"]
+    )
+    if not patients:
+        return
+
+    # Later rows are newer, so the newest draft per customer wins
+    drafts = dict(frappe.get_all(
+        "Sales Invoice", filters={"docstatus": 0}, fields=["customer", "name"], order_by="creation asc", as_list=True
+    ))
+    if not drafts:
+        return
+
+    customers = frappe.get_all(
+        "Customer", filters={"name": ["in", list(drafts)]}, fields=["name", "customer_name", "custom_patient"]
+    )
+    by_patient = {customer.custom_patient: customer.name for customer in customers if customer.custom_patient}
+    by_name = {customer.customer_name: customer.name for customer in customers if not customer.custom_patient}
+    name_counts = Counter(frappe.get_all("Patient", pluck="patient_name"))
+    shared_names = {name for name, count in name_counts.items() if count > 1}
+
+    for patient in patients:
+        keys = [patient.customer, by_patient.get(patient.name), patient.name]
+        if patient.patient_name not in shared_names:
+            keys.append(by_name.get(patient.patient_name))
+        sales_invoice = next((drafts[key] for key in keys if key in drafts), None)
+        if sales_invoice:
+            frappe.db.set_value(
+                "Patient", patient.name, "custom_billing_invoice", sales_invoice, update_modified=False
+            )
@@ -0,0 +1,13 @@
+import frappe
+
+# Superseded by the (patient, custom_archived, template_dt, template_dn) index, which serves every
+# lookup it did; keeping both only made every Service Request write maintain two indexes
+INDEX_NAME = "patient_template_dt_template_dn_index"
+
+
+def execute():
+    """
+    Drops the Service Request index on (patient, template_dt, template_dn) from sites that got it.
+    """
+    if frappe.db.has_index("tabService Request", INDEX_NAME):
+        frappe.db.sql_ddl(f"alter table `tabService Request` drop index `{INDEX_NAME}`")
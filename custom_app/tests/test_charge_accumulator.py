@@ -0,0 +1,152 @@
+import threading
+from unittest.mock import patch
+
+import frappe
+from erpnext.accounts.doctype.sales_invoice.test_sales_invoice import create_sales_invoice
+from frappe.tests.utils import FrappeTestCase
+
+from custom_app.custom_app import charge_accumulator
+
+test_dependencies = ["Company", "Customer", "Item"]
+
+ITEM_CODE = "_Test Item"
+SUBMITTERS = 6
+FLUSHERS = 4
+SERVICES_PER_SUBMITTER = 10
+
+
+def make_patient():
+    """
+    Returns a committed patient with a draft billing invoice of its own.
+    """
+    frappe.flags.custom_app_skip_patient_billing = True
+    try:
+        patient = frappe.get_doc({
+            "doctype": "Patient",
+            "first_name": "_Test Charge Stress",
+            "sex": "Male",
+        }).insert(ignore_permissions=True)
+    finally:
+        frappe.flags.custom_app_skip_patient_billing = False
+
+    sales_invoice = create_sales_invoice(item_code=ITEM_CODE, do_not_save=1)
+    sales_invoice.insert(ignore_permissions=True)
+    patient.db_set("custom_billing_invoice", sales_invoice.name, update_modified=False)
+    return patient.name, sales_invoice.name
+
+def make_medication_request(patient):
+    """
+    Returns a draft Medication Request of the patient, ready to be submitted.
+    """
+    medication_request = frappe.get_doc({
+        "doctype": "Medication Request",
+        "patient": patient,
+        "medication": ITEM_CODE,
+        "medication_item": ITEM_CODE,
+    })
+    medication_request.flags.ignore_mandatory = True
+    medication_request.flags.ignore_links = True
+    return medication_request.insert(ignore_permissions=True).name
+
+def submit_medication_request(name):
+    medication_request = frappe.get_doc("Medication Request", name)
+    medication_request.flags.ignore_mandatory = True
+    medication_request.flags.ignore_links = True
+    medication_request.flags.ignore_permissions = True
+    medication_request.submit()
+
+def run_in_thread(site, sites_path, target, errors):
+    """
+    Runs `target` with a site connection of its own, as a separate web or worker process would.
+    """
+    frappe.init(site=site, sites_path=sites_path)
+    frappe.connect()
+    try:
+        target()
+    except Exception:
+        errors.append(frappe.get_traceback())
+    finally:
+        frappe.destroy()
+
+
+class TestChargeAccumulatorConcurrency(FrappeTestCase):
+    """
+    Medication Requests of one patient are submitted from several connections at once, so their
+    real `on_submit` billing hooks record charges while several flushes drain the patient's outbox;
+    no submit may fail, and every service must end up posted as exactly one invoice line.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # The threads use their own connections, so the fixtures have to be committed
+        cls.patient, cls.invoice = make_patient()
+        cls.services = [make_medication_request(cls.patient) for _i in range(SUBMITTERS * SERVICES_PER_SUBMITTER)]
+        frappe.db.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        frappe.db.delete("Pending Charge", {"patient": cls.patient})
+        frappe.db.delete("Inpatient Billing Summary", {"patient": cls.patient})
+        frappe.db.delete("Medication Request", {"patient": cls.patient})
+        frappe.delete_doc("Sales Invoice", cls.invoice, force=True, ignore_permissions=True)
+        frappe.delete_doc("Patient", cls.patient, force=True, ignore_permissions=True)
+        frappe.db.commit()
+        super().tearDownClass()
+
+    def test_every_submitted_service_is_posted_exactly_once(self):
+        errors = []
+        submitters_done = threading.Event()
+
+        def submit(submitter):
+            start = submitter * SERVICES_PER_SUBMITTER
+            for name in self.services[start:start + SERVICES_PER_SUBMITTER]:
+                submit_medication_request(name)
+                frappe.db.commit()
+
+        def flush():
+            while not submitters_done.is_set():
+                charge_accumulator.flush_pending_charges(self.patient)
+
+        site, sites_path = frappe.local.site, frappe.local.sites_path
+        with patch.object(charge_accumulator, "enqueue_flush"):
+            submitters = [
+                threading.Thread(target=run_in_thread, args=(site, sites_path, lambda s=s: submit(s), errors))
+                for s in range(SUBMITTERS)
+            ]
+            flushers = [
+                threading.Thread(target=run_in_thread, args=(site, sites_path, flush, errors))
+                for _f in range(FLUSHERS)
+            ]
+            for thread in submitters + flushers:
+                thread.start()
+            for thread in submitters:
+                thread.join()
+            submitters_done.set()
+            for thread in flushers:
+                thread.join()
+
+            # Whatever the flushers left behind
+            charge_accumulator.flush_pending_charges(self.patient)
+
+        self.assertEqual(errors, [])
+        submitted = frappe.get_all("Medication Request", filters={"patient": self.patient, "docstatus": 1}, pluck="name")
+        self.assertEqual(sorted(submitted), sorted(self.services))
+
+        charges = frappe.get_all(
+            "Pending Charge",
+            filters={"patient": self.patient},
+            fields=["service_doctype", "service_name", "status", "sales_invoice", "sales_invoice_item"]
+        )
+        self.assertEqual({charge.service_doctype for charge in charges}, {"Medication Request"})
+        self.assertEqual(sorted(charge.service_name for charge in charges), sorted(self.services))
+        self.assertEqual({charge.status for charge in charges}, {"Posted"})
+        self.assertEqual({charge.sales_invoice for charge in charges}, {self.invoice})
+
+        # The opening line is the only one not billing a charge
+        lines = frappe.get_all("Sales Invoice Item", filters={"parent": self.invoice}, pluck="name")
+        charged_lines = [charge.sales_invoice_item for charge in charges]
+        self.assertEqual(len(charged_lines), len(set(charged_lines)))
+        self.assertEqual(len(lines), len(charged_lines) + 1)
+        self.assertTrue(set(charged_lines) <= set(lines))
+        self.assertEqual(frappe.db.get_value("Inpatient Billing Summary", self.patient, "line_count"), len(charges))
@@ -0,0 +1,392 @@
+from unittest.mock import MagicMock, patch
+
+import frappe
+from frappe.model.document import Document
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import nowdate
+
+from custom_app.custom_app import inpatient_handler
+from custom_app.custom_app.inpatient_handler import (
+    get_pending_services,
+    get_retry_queue,
+    prepare_orders,
+    set_retry_queue,
+)
+
+test_dependencies = ["Company", "Item Group"]
+
+SAMPLE = "_Test Rollback Sample"
+TEMPLATE_OK = "_Test Rollback Lab OK"
+TEMPLATE_FAILING = "_Test Rollback Lab Failing"
+
+
+def make_record(status, rows, retry_queue=None):
+    """
+    Returns an unsaved Inpatient Record with one lab prescription per `(name, code, linked)` row.
+    """
+    doc = frappe.new_doc("Inpatient Record")
+    doc.status = status
+    for name, code, linked in rows:
+        doc.append("lab_test_prescription", {"name": name, "lab_test_code": code, "custom_linked_document": linked})
+    set_retry_queue(doc, retry_queue)
+    return doc
+
+def ensure_doc(doctype, name, values):
+    if not frappe.db.exists(doctype, name):
+        doc = frappe.get_doc({"doctype": doctype, **values})
+        doc.flags.ignore_mandatory = True
+        doc.insert(ignore_permissions=True, set_name=name)
+    return name
+
+def make_service_fixtures():
+    """
+    Creates the masters a real service run needs: a sample, two lab templates drawing it,
+    a practitioner and the Draft status of Service Requests.
+    """
+    ensure_doc("Lab Test Sample", SAMPLE, {"sample": SAMPLE})
+    for template in (TEMPLATE_OK, TEMPLATE_FAILING):
+        ensure_doc("Lab Test Template", template, {
+            "lab_test_name": template,
+            "lab_test_code": template,
+            "lab_test_template_type": "Single",
+            "lab_test_group": "All Item Groups",
+            "is_billable": 0,
+            "sample": SAMPLE,
+        })
+    ensure_doc("Code System", "_Test Rollback Codes", {"code_system": "_Test Rollback Codes"})
+    if not frappe.db.exists("Code Value", {"code_value": "Draft"}):
+        ensure_doc("Code Value", "_Test Rollback Draft", {
+            "code_system": "_Test Rollback Codes",
+            "code_value": "Draft",
+            "display": "Draft",
+        })
+    return ensure_doc("Healthcare Practitioner", "_Test Rollback Practitioner", {
+        "first_name": "_Test Rollback Practitioner",
+    })
+
+def get_pending_names(doc, doc_before_save):
+    doc._doc_before_save = doc_before_save
+    return [row.name for _table, row in get_pending_services(doc)]
+
+
+class TestPendingServices(FrappeTestCase):
+    def test_new_record_processes_unlinked_rows(self):
+        doc = make_record("Admitted", [("a", "CBC", None), ("b", "LFT", "LT-0001")])
+        self.assertEqual(get_pending_names(doc, None), ["a"])
+
+    def test_added_rows_are_pending(self):
+        before = make_record("Admitted", [("a", "CBC", None)])
+        doc = make_record("Admitted", [("a", "CBC", None), ("b", "LFT", None)])
+        self.assertEqual(get_pending_names(doc, before), ["b"])
+
+    def test_edited_rows_are_not_pending(self):
+        before = make_record("Admitted", [("a", "CBC", "LT-0001"), ("b", "LFT", None)])
+        doc = make_record("Admitted", [("a", "ESR", "LT-0001"), ("b", "KFT", None)])
+        self.assertEqual(get_pending_names(doc, before), [])
+
+    def test_deleted_rows_are_not_pending(self):
+        before = make_record("Admitted", [("a", "CBC", None), ("b", "LFT", None)])
+        doc = make_record("Admitted", [("b", "LFT", None)])
+        self.assertEqual(get_pending_names(doc, before), [])
+
+    def test_queued_retries_are_pending(self):
+        before = make_record("Admitted", [("a", "CBC", None), ("b", "LFT", None)], retry_queue=["a"])
+        doc = make_record("Admitted", [("a", "CBC", None), ("b", "LFT", None)])
+        self.assertEqual(get_pending_names(doc, before), ["a"])
+
+    def test_rows_added_while_scheduled_are_pending_on_admission(self):
+        rows = [("a", "CBC", None), ("b", "LFT", "LT-0001")]
+        before = make_record("Admission Scheduled", rows)
+        doc = make_record("Admitted", [*rows, ("c", "KFT", None)])
+        self.assertEqual(get_pending_names(doc, before), ["a", "c"])
+
+
+class TestPrepareOrders(FrappeTestCase):
+    def test_only_prescription_fields_are_copied(self):
+        doc = make_record("Admitted", [])
+        doc.name = "IP-TEST-ORDERS"
+        doc.patient = "_Test Orders Patient"
+        _results, pending = prepare_orders(doc, [{
+            "service_type": "Lab Test",
+            "service_name": "_Test CBC",
+            "lab_test_name": "Complete Blood Count",
+            "name": "forged-row",
+            "parent": "another-record",
+            "parentfield": "drug_prescription",
+            "custom_linked_document": "LT-FORGED",
+            "custom_service_status": "Done",
+            "not_a_field": 1,
+        }])
+
+        [(_index, _table, row)] = pending
+        self.assertEqual(row.lab_test_code, "_Test CBC")
+        self.assertEqual(row.lab_test_name, "Complete Blood Count")
+        self.assertNotEqual(row.name, "forged-row")
+        self.assertEqual(row.parent, doc.name)
+        self.assertEqual(row.parentfield, "lab_test_prescription")
+        self.assertFalse(row.custom_linked_document)
+        self.assertFalse(row.custom_service_status)
+        self.assertIsNone(row.get("not_a_field"))
+
+
+class TestServiceFailures(FrappeTestCase):
+    """
+    Failures are injected into service creation; the failed rows must land in the retry queue
+    without affecting the other rows, and be retried on the next save.
+    """
+
+    def setUp(self):
+        self.failing = set()
+        patches = (
+            patch.object(inpatient_handler.service_queue, "is_async_enabled", return_value=False),
+            patch.object(inpatient_handler, "ServiceRunContext", return_value=MagicMock(get_row_problem=lambda *args: None)),
+            patch.object(inpatient_handler, "create_service_for_row", side_effect=self.create_service_for_row),
+            patch.object(inpatient_handler, "create_specimens_for_lab_tests"),
+        )
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def create_service_for_row(self, doc, table, row, context):
+        if row.name in self.failing:
+            raise frappe.ValidationError(f"Injected failure for {row.name}")
+        return f"LT-{row.name}"
+
+    def test_failed_row_is_queued_and_others_are_linked(self):
+        self.failing = {"b"}
+        doc = make_record("Admitted", [("a", "CBC", None), ("b", "LFT", None), ("c", "KFT", None)])
+        inpatient_handler.create_services(doc)
+
+        rows = {row.name: row for row in doc.lab_test_prescription}
+        self.assertEqual(rows["a"].custom_linked_document, "LT-a")
+        self.assertEqual(rows["c"].custom_linked_document, "LT-c")
+        self.assertFalse(rows["b"].custom_linked_document)
+        self.assertEqual(rows["b"].custom_service_status, "Failed")
+        self.assertEqual(get_retry_queue(doc), ["b"])
+
+    def test_queued_row_is_retried_on_next_save(self):
+        rows = [("a", "CBC", "LT-a"), ("b", "LFT", None)]
+        doc = make_record("Admitted", rows)
+        doc._doc_before_save = make_record("Admitted", rows, retry_queue=["b"])
+        inpatient_handler.create_services(doc)
+
+        self.assertEqual(doc.lab_test_prescription[1].custom_linked_document, "LT-b")
+        self.assertEqual(get_retry_queue(doc), [])
+
+    def test_row_failing_again_stays_queued(self):
+        self.failing = {"b"}
+        rows = [("a", "CBC", "LT-a"), ("b", "LFT", None)]
+        doc = make_record("Admitted", [*rows, ("c", "KFT", None)])
+        doc._doc_before_save = make_record("Admitted", rows, retry_queue=["b"])
+        inpatient_handler.create_services(doc)
+
+        self.assertEqual(doc.lab_test_prescription[2].custom_linked_document, "LT-c")
+        self.assertEqual(get_retry_queue(doc), ["b"])
+
+    def test_stale_form_does_not_overwrite_the_queue(self):
+        # The worker queued "b" after the form was loaded; the form is then saved on discharge
+        rows = [("a", "CBC", "LT-a"), ("b", "LFT", None)]
+        doc = make_record("Discharged", rows)
+        doc._doc_before_save = make_record("Admitted", rows, retry_queue=["b"])
+        inpatient_handler.create_services(doc)
+
+        self.assertEqual(get_retry_queue(doc), ["b"])
+
+
+class TestServiceStepFailures(FrappeTestCase):
+    """
+    Failures are injected into the real inserts of one run: a failing row must leave no
+    Lab Test or Service Request behind and land in the retry queue, while a failing
+    Specimen step must leave the services of every row in place.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.practitioner = make_service_fixtures()
+
+    def setUp(self):
+        # Every test admits its own patient; the savepoint drops them afterwards
+        frappe.db.savepoint("test_service_step_failures")
+        self.addCleanup(frappe.db.rollback, save_point="test_service_step_failures")
+
+        patch_async = patch.object(inpatient_handler.service_queue, "is_async_enabled", return_value=False)
+        patch_async.start()
+        self.addCleanup(patch_async.stop)
+
+        frappe.flags.custom_app_skip_patient_billing = True
+        try:
+            self.patient = frappe.get_doc({
+                "doctype": "Patient",
+                "first_name": f"_Test Rollback {frappe.generate_hash(length=8)}",
+                "sex": "Male",
+            }).insert(ignore_permissions=True).name
+        finally:
+            frappe.flags.custom_app_skip_patient_billing = False
+
+        # Inserted while only scheduled, so saving it creates no services yet
+        record = frappe.get_doc({
+            "doctype": "Inpatient Record",
+            "patient": self.patient,
+            "gender": "Male",
+            "company": "_Test Company",
+            "status": "Admission Scheduled",
+            "scheduled_date": nowdate(),
+            "primary_practitioner": self.practitioner,
+        })
+        record.flags.ignore_mandatory = True
+        self.record = record.insert(ignore_permissions=True)
+
+    def run_services(self):
+        doc = self.record
+        doc.status = "Admitted"
+        doc.append("lab_test_prescription", {"name": "row-ok", "lab_test_code": TEMPLATE_OK})
+        doc.append("lab_test_prescription", {"name": "row-failing", "lab_test_code": TEMPLATE_FAILING})
+        inpatient_handler.create_services(doc)
+        return {row.name: row for row in doc.lab_test_prescription}
+
+    def fail_insert(self, doctype, should_fail):
+        """
+        Makes `Document.insert` raise for the `doctype` documents `should_fail` accepts.
+        """
+        insert = Document.insert
+
+        def failing_insert(doc, *args, **kwargs):
+            if doc.doctype == doctype and should_fail(doc):
+                raise frappe.ValidationError(f"Injected {doctype} failure")
+            return insert(doc, *args, **kwargs)
+
+        patcher = patch.object(Document, "insert", failing_insert)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_lab_tests(self):
+        return frappe.get_all(
+            "Lab Test",
+            filters={"inpatient_record": self.record.name},
+            fields=["name", "template", "custom_specimen"]
+        )
+
+    def get_service_requests(self):
+        return frappe.get_all(
+            "Service Request",
+            filters={"patient": self.patient, "template_dt": "Lab Test"},
+            pluck="template_dn"
+        )
+
+    def assert_failing_row_left_nothing(self, rows):
+        lab_tests = self.get_lab_tests()
+        self.assertEqual([lab_test.template for lab_test in lab_tests], [TEMPLATE_OK])
+        self.assertEqual(self.get_service_requests(), [lab_tests[0].name])
+
+        self.assertEqual(rows["row-ok"].custom_linked_document, lab_tests[0].name)
+        self.assertFalse(rows["row-failing"].custom_linked_document)
+        self.assertEqual(rows["row-failing"].custom_service_status, "Failed")
+        self.assertEqual(get_retry_queue(self.record), ["row-failing"])
+
+    def assert_services_kept_without_specimen(self, rows):
+        lab_tests = self.get_lab_tests()
+        self.assertEqual(sorted(lab_test.template for lab_test in lab_tests), [TEMPLATE_FAILING, TEMPLATE_OK])
+        self.assertEqual(sorted(self.get_service_requests()), sorted(lab_test.name for lab_test in lab_tests))
+        self.assertEqual({lab_test.custom_specimen for lab_test in lab_tests}, {None})
+        self.assertFalse(frappe.db.exists("Specimen", {"patient": self.patient}))
+
+        self.assertEqual({row.custom_service_status for row in rows.values()}, {"Done"})
+        self.assertEqual(get_retry_queue(self.record), [])
+
+    def test_successful_run_links_every_row_to_one_specimen(self):
+        rows = self.run_services()
+
+        lab_tests = self.get_lab_tests()
+        self.assertEqual({row.custom_linked_document for row in rows.values()}, {lab_test.name for lab_test in lab_tests})
+        self.assertEqual(sorted(self.get_service_requests()), sorted(lab_test.name for lab_test in lab_tests))
+        specimen = frappe.db.get_value("Specimen", {"patient": self.patient, "sample_name": SAMPLE})
+        self.assertTrue(specimen)
+        self.assertEqual({lab_test.custom_specimen for lab_test in lab_tests}, {specimen})
+        self.assertEqual(get_retry_queue(self.record), [])
+
+    def test_failed_service_insert_queues_the_row(self):
+        self.fail_insert("Lab Test", lambda lab_test: lab_test.template == TEMPLATE_FAILING)
+        self.assert_failing_row_left_nothing(self.run_services())
+
+    def test_failed_service_request_insert_rolls_back_the_service(self):
+        # The Lab Test of the row is already inserted when its Service Request fails
+        self.fail_insert(
+            "Service Request",
+            lambda request: frappe.db.get_value("Lab Test", request.template_dn, "template") == TEMPLATE_FAILING
+        )
+        self.assert_failing_row_left_nothing(self.run_services())
+
+    def test_failed_specimen_insert_keeps_the_services(self):
+        self.fail_insert("Specimen", lambda specimen: True)
+        self.assert_services_kept_without_specimen(self.run_services())
+
+    def test_failed_specimen_link_rolls_back_the_specimen(self):
+        # The Specimen is inserted, then linking the Lab Tests to it fails
+        with patch.object(inpatient_handler.frappe.db, "set_value", side_effect=frappe.ValidationError("Injected link failure")):
+            rows = self.run_services()
+        self.assert_services_kept_without_specimen(rows)
+
+
+class TestSpecimenGrouping(FrappeTestCase):
+    """
+    Lab Tests are linked to one Specimen per sample, reusing the Specimen of an earlier run
+    in the same collection window.
+    """
+
+    def setUp(self):
+        self.context = MagicMock(
+            collection_window="2026-10-18 09:00:00",
+            masters={"Lab Test Template": {
+                "CBC": frappe._dict(sample="Blood"),
+                "LFT": frappe._dict(sample="Blood"),
+                "Urinalysis": frappe._dict(sample="Urine"),
+                "Consult": frappe._dict(sample=None),
+            }},
+        )
+        self.doc = frappe._dict(patient="_Test Specimen Patient")
+        self.inserted = []
+
+    def run_grouping(self, lab_tests, existing=()):
+        def get_doc(values):
+            specimen = MagicMock(name="Specimen")
+            specimen.name = f"SPM-{values['sample_name']}"
+            specimen.insert.side_effect = lambda **kwargs: self.inserted.append(values)
+            return specimen
+
+        with (
+            patch.object(inpatient_handler.frappe, "get_all", return_value=list(existing)) as get_all,
+            patch.object(inpatient_handler.frappe, "get_doc", side_effect=get_doc),
+            patch.object(inpatient_handler.frappe.db, "set_value") as set_value,
+        ):
+            inpatient_handler.create_specimens_for_lab_tests(self.doc, lab_tests, self.context)
+
+        links = {call.args[3]: sorted(call.args[1]["name"][1]) for call in set_value.call_args_list}
+        return get_all, links
+
+    def test_tests_sharing_a_sample_share_a_specimen(self):
+        _get_all, links = self.run_grouping([("LT-1", "CBC"), ("LT-2", "LFT"), ("LT-3", "Urinalysis")])
+
+        self.assertEqual(links, {"SPM-Blood": ["LT-1", "LT-2"], "SPM-Urine": ["LT-3"]})
+        self.assertEqual(sorted(values["sample_name"] for values in self.inserted), ["Blood", "Urine"])
+        for values in self.inserted:
+            self.assertEqual(values["patient"], self.doc.patient)
+            self.assertEqual(values["custom_collection_window"], self.context.collection_window)
+
+    def test_specimen_of_the_same_window_is_reused(self):
+        get_all, links = self.run_grouping(
+            [("LT-1", "CBC"), ("LT-2", "Urinalysis")], existing=[("Blood", "SPM-EARLIER")]
+        )
+
+        self.assertEqual(links, {"SPM-EARLIER": ["LT-1"], "SPM-Urine": ["LT-2"]})
+        self.assertEqual([values["sample_name"] for values in self.inserted], ["Urine"])
+        filters = get_all.call_args.kwargs["filters"]
+        self.assertEqual(filters["custom_collection_window"], self.context.collection_window)
+        self.assertEqual(filters["patient"], self.doc.patient)
+
+    def test_tests_without_a_sample_get_no_specimen(self):
+        get_all, links = self.run_grouping([("LT-1", "Consult"), ("LT-2", "Unknown")])
+
+        self.assertEqual(links, {})
+        self.assertEqual(self.inserted, [])
+        get_all.assert_not_called()